@@ -1,3 +1,5 @@
+from SpheroLib.metrics import record_latency
+from SpheroLib.log_ring import log_message
 import pyrealsense2 as rs
 import time
 import numpy as np
@@ -6,7 +8,7 @@ import cv2
 
 def run_camera(shared_resources):
     shared_resources.get_numpy_resources()
-    shared_resources.resources["logging_queue"].put("[run camera] Running the camera stream")
+    log_message(shared_resources, "camera", "[run camera] Running the camera stream")
     # Configure depth and color streams
     pipeline = rs.pipeline()
     cam_config = rs.config()
@@ -25,7 +27,7 @@ def run_camera(shared_resources):
 
     try:
         while True:
-            time.sleep(.001)
+            # Blocks until the next frameset arrives
             frames = pipeline.wait_for_frames()
             depth_frame = frames.get_depth_frame()
             color_frame = frames.get_color_frame()
@@ -33,25 +35,42 @@ def run_camera(shared_resources):
             if color_frame:
                 color_image = np.asanyarray(color_frame.get_data(),
                                             dtype=np.uint8)
-                shared_resources.resources["np_array_timestamps"][0] = timestamp
-                shared_resources.resources["np_array_packet_counters"][0] += 1
-                with shared_resources.resources["rgbd_pointer_lock"]:
-                    shared_resources.resources["np_array_rgb"][shared_resources.resources["rgb_ring_buffer_pointer"].value]\
-                        = np.expand_dims(color_image, axis=0)
+                shared_resources.begin_write(0)
+                try:
+                    pointer = shared_resources.resources["rgb_ring_buffer_pointer"].value
+                    shared_resources.resources["np_array_rgb_timestamps"][pointer] = timestamp
+                    shared_resources.resources["np_array_rgb"][pointer] = np.expand_dims(color_image, axis=0)
                     shared_resources.resources["rgb_ring_buffer_pointer"].value = \
-                        (shared_resources.resources["rgb_ring_buffer_pointer"].value + 1) % \
-                        shared_resources.resources["np_array_rgb"].shape[0]
+                        (pointer + 1) % shared_resources.resources["np_array_rgb"].shape[0]
+                    shared_resources.resources["np_array_timestamps"][0] = timestamp
+                    shared_resources.resources["np_array_packet_counters"][0] += 1
+                finally:
+                    shared_resources.end_write(0)
+                record_frame_latency(shared_resources, "rgb_arrival", color_frame)
 
             if depth_frame:
                 depth_image = np.asanyarray(depth_frame.get_data(),
                                             dtype=np.uint16)
-                shared_resources.resources["np_array_timestamps"][1] = timestamp
-                shared_resources.resources["np_array_packet_counters"][1] += 1
-                with shared_resources.resources["rgbd_pointer_lock"]:
-                    shared_resources.resources["np_array_depth"][shared_resources.resources["depth_ring_buffer_pointer"].value] \
-                        = np.expand_dims(depth_image, axis=0)
+                shared_resources.begin_write(1)
+                try:
+                    pointer = shared_resources.resources["depth_ring_buffer_pointer"].value
+                    shared_resources.resources["np_array_depth_timestamps"][pointer] = timestamp
+                    shared_resources.resources["np_array_depth"][pointer] = np.expand_dims(depth_image, axis=0)
                     shared_resources.resources["depth_ring_buffer_pointer"].value = \
-                        (shared_resources.resources["depth_ring_buffer_pointer"].value + 1) % \
-                        shared_resources.resources["np_array_depth"].shape[0]
+                        (pointer + 1) % shared_resources.resources["np_array_depth"].shape[0]
+                    shared_resources.resources["np_array_timestamps"][1] = timestamp
+                    shared_resources.resources["np_array_packet_counters"][1] += 1
+                finally:
+                    shared_resources.end_write(1)
+                record_frame_latency(shared_resources, "depth_arrival", depth_frame)
     finally:
         pipeline.stop()
+
+
+def record_frame_latency(shared_resources, metric, frame):
+    """
+    Time from the camera capturing a frame to it landing in shared memory. Frames stamped by the
+    camera's own clock can't be compared to ours and are skipped.
+    """
+    if frame.get_frame_timestamp_domain() != rs.timestamp_domain.hardware_clock:
+        record_latency(shared_resources, metric, time.time() - frame.get_timestamp() / 1000)
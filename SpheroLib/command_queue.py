@@ -0,0 +1,94 @@
+from collections import deque
+import threading
+import time
+
+# Command priorities, sent lowest number first and oldest first within a priority
+PRIORITY_DRIVE = 0
+PRIORITY_YAW = 1
+PRIORITY_CONFIG = 2
+PRIORITY_LEDS = 3
+NUM_PRIORITIES = 4
+
+# Columns of a sphero's row in np_array_sphero_command_queue_stats
+COMMAND_QUEUE_STATS = ["depth", "max_depth", "sent", "coalesced"]
+
+
+class CommandQueue:
+    """
+    BLE writes waiting on the link. Up to max_outstanding writes are in flight at once, the rest wait in
+    one deque per priority. A command put with a coalesce_key replaces a still waiting command with the
+    same key in place, so e.g. a new drive command supersedes an unsent one instead of queueing behind it.
+
+    write_fn(characteristic_uuid, value) does the actual write, and write_done() must be called once it
+    succeeds or fails. record_wait(seconds) is called with each command's time in the queue, and stats is
+    an optional array row that gets COMMAND_QUEUE_STATS.
+    """
+
+    def __init__(self, write_fn, max_outstanding=1, record_wait=None, stats=None):
+        self.write_fn = write_fn
+        self.max_outstanding = max_outstanding
+        self.record_wait = record_wait
+        self.stats = stats
+        self.queues = [deque() for _ in range(NUM_PRIORITIES)]
+        self.waiting = dict()
+        self.depth = 0
+        self.outstanding = 0
+        # Commands come from timer threads as well as the bluetooth main loop
+        self.lock = threading.RLock()
+
+    def put(self, characteristic_uuid, value, priority=PRIORITY_CONFIG, coalesce_key=None):
+        with self.lock:
+            if coalesce_key is not None and coalesce_key in self.waiting:
+                self.waiting[coalesce_key][1] = value
+                if self.stats is not None:
+                    self.stats[3] += 1
+                return
+            # [characteristic_uuid, value, enqueue time, coalesce_key]
+            entry = [characteristic_uuid, value, time.time(), coalesce_key]
+            if coalesce_key is not None:
+                self.waiting[coalesce_key] = entry
+            self.queues[priority].append(entry)
+            self.depth += 1
+            if self.stats is not None:
+                self.stats[0] = self.depth
+                self.stats[1] = max(self.stats[1], self.depth)
+            self.send()
+
+    def discard(self, coalesce_key):
+        """
+        Drop the still waiting command put with coalesce_key, if there is one.
+        """
+        with self.lock:
+            entry = self.waiting.pop(coalesce_key, None)
+            if entry is None:
+                return
+            next(queue for queue in self.queues if entry in queue).remove(entry)
+            self.depth -= 1
+            if self.stats is not None:
+                self.stats[0] = self.depth
+
+    def send(self):
+        """
+        Write waiting commands while there are free write slots.
+        """
+        with self.lock:
+            while self.depth and self.outstanding < self.max_outstanding:
+                entry = next(queue for queue in self.queues if queue).popleft()
+                self.depth -= 1
+                if entry[3] is not None:
+                    del self.waiting[entry[3]]
+                if self.stats is not None:
+                    self.stats[0] = self.depth
+                    self.stats[2] += 1
+                if self.record_wait is not None:
+                    self.record_wait(time.time() - entry[2])
+                self.outstanding += 1
+                self.write_fn(entry[0], entry[1])
+
+    def write_done(self):
+        """
+        A write was acknowledged or failed. Free its slot for the next command.
+        """
+        with self.lock:
+            self.outstanding = max(self.outstanding - 1, 0)
+            self.send()
@@ -1,6 +1,9 @@
 """
 Things that are user specified
 """
+import json
+import os
+
 sphero_config = {
     "SIMULTANEOUS_SPHEROS": 2,
     "SPHEROMACS": [
@@ -35,9 +38,66 @@ sphero_config = {
     # Security risk. Slack token for publishing charging info to #sphero_slack.
     "SLACKTOKEN": "hello-world",
 
-    # DONT TOUCH THESE
-    "SPHERO_SENSOR_RATE": 9,  # hz, Estimate from inspection
+    # Name of the shared memory segment holding the sensor buffers. Other processes can read them
+    # with SpheroLibrary.attach(name) while the library runs.
+    "SHARED_MEMORY_NAME": "sphero_library",
+
+    # Append every raw BLE notification (hex, one per line) to Logs/sphero<n>_notifications.txt.
+    # Used by the decoder benchmark in library_unit_tests.py.
+    "SPHERO_NOTIFICATION_CAPTURE": False,
+
+    # How often each sphero process logs how many of each message type it has received
+    "SPHERO_MESSAGE_COUNT_LOG_SECS": 60,
+
+    # Number of processes the spheros are sharded across, each driving its spheros on one bluetooth
+    # event loop. None for one process per sphero.
+    "SPHERO_PROCESSES": None,
+    # How often running spheros are asked for their battery voltage. None to only ask at start up.
+    "SPHERO_BATTERY_POLL_SECS": None,
+    # A sphero that drops its connection reconnects after SPHERO_RESTART_MIN_SECS, doubling the wait on each
+    # failed attempt up to SPHERO_RESTART_MAX_SECS. Dead worker processes are respawned the same way.
+    "SPHERO_RESTART_MIN_SECS": .25,
+    "SPHERO_RESTART_MAX_SECS": 30,
+
+    # BLE writes each sphero keeps in flight before queueing the rest
+    "BLE_MAX_OUTSTANDING_WRITES": 1,
 
+    # Reset yaw before every action so its heading is relative to where the sphero faces. If False,
+    # the heading is made relative using the latest sensor yaw, saving a round trip per action.
+    "SPHERO_ACTION_RESET_YAW": True,
+    # Resend an action's reset yaw / roll if it is not acked within this long
+    "SPHERO_ACTION_RETRY_SECS": .2,
+
+    # Rate we ask the spheros to stream sensor packets at, hz. Only the sensors in SPHERO_OUTPUT_VARIABLES
+    # are streamed.
+    "SPHERO_TARGET_SENSOR_RATE": 10,
+    # Fraction of the target rate that actually arrives, used to size buffers until the sensor monitor
+    # has measured it. 9hz at 10hz from inspection.
+    "SPHERO_SENSOR_RATE_ESTIMATE": .9,
+    # How often the sensor monitor records the measured sphero sensor rate
+    "SPHERO_SENSOR_RATE_MEASURE_SECS": 60,
+    # Plausible measured rates, as fractions of the target rate. A measurement outside is clamped to
+    # them before it is saved, and a saved rate outside them is ignored.
+    "SPHERO_SENSOR_RATE_BOUNDS": [.5, 1.],
+
+    # Each stream's period and jitter are tracked as moving averages, weighting each new interval by this
+    "STREAM_RATE_EWMA_ALPHA": .05,
+    # A stream is lost once it has been quiet for this many of its expected periods, but never sooner than
+    # STREAM_LOST_MIN_SECS. It is degraded while its measured period is over STREAM_DEGRADED_RATIO times
+    # the expected one (e.g. the camera at 15fps of 30)
+    "STREAM_LOST_PERIODS": 30,
+    "STREAM_LOST_MIN_SECS": 2,
+    "STREAM_DEGRADED_RATIO": 1.5,
+
+    # Records each log source can have waiting on the logger before it drops them, and how often the
+    # logger writes them out to Logs/Library.log (read it with python -m SpheroLib.log_ring)
+    "LOG_RING_LENGTH": 1024,
+    "LOG_FLUSH_SECS": .5,
+
+    # Library state transitions kept in the shared trace ring (see SpheroLibrary.get_state_trace)
+    "STATE_TRACE_LENGTH": 256,
+
+    # DONT TOUCH THESE
     "SPHERO_OUTPUT_VARIABLES": [
         'positionX', 'positionY',
         'velocityX', 'velocityY',
@@ -56,4 +116,18 @@ sphero_config["AUDIO_BYTES_PER_SAMPLE"] = int(
 sphero_config["AUDIO_LENGTH_STATE"] = int(sphero_config["AUDIO_STATE_SECS"] / sphero_config["AUDIO_SECS_PER_SAMPLE"])
 sphero_config["AUDIO_BYTES_PER_STATE"] = int(
     sphero_config["AUDIO_BYTES_PER_SECOND"] * sphero_config["AUDIO_STATE_SECS"])
+sphero_config["SPHERO_SENSOR_INTERVAL_MS"] = int(round(1000 / sphero_config["SPHERO_TARGET_SENSOR_RATE"]))
+# Sphero sensor rate measured by the sensor monitor on an earlier run with the same stream, if there was one
+sphero_config["SPHERO_SENSOR_RATE_PATH"] = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../Logs/sphero_sensor_rate.json"))
+sphero_config["SPHERO_SENSOR_RATE"] = sphero_config["SPHERO_TARGET_SENSOR_RATE"] * sphero_config["SPHERO_SENSOR_RATE_ESTIMATE"]
+if os.path.exists(sphero_config["SPHERO_SENSOR_RATE_PATH"]):
+    with open(sphero_config["SPHERO_SENSOR_RATE_PATH"]) as rate_file:
+        measured = json.load(rate_file)
+    min_rate, max_rate = [bound * sphero_config["SPHERO_TARGET_SENSOR_RATE"]
+                          for bound in sphero_config["SPHERO_SENSOR_RATE_BOUNDS"]]
+    if measured["interval_ms"] == sphero_config["SPHERO_SENSOR_INTERVAL_MS"] and \
+            sorted(measured["variables"]) == sorted(sphero_config["SPHERO_OUTPUT_VARIABLES"]) and \
+            min_rate <= measured["rate"] <= max_rate:
+        sphero_config["SPHERO_SENSOR_RATE"] = measured["rate"]
 sphero_config["SPHERO_LENGTH_STATE"] = int(sphero_config["STATE_LEN_TIME_SECS"] * sphero_config["SPHERO_SENSOR_RATE"])
@@ -1,5 +1,6 @@
 import numpy as np
 from SpheroLib.shared_resources import SharedResources
+from SpheroLib.state_machine import SPHERO_READY, STATES, STATE_NAMES
 
 
 class SpheroLibrary:
@@ -8,7 +9,7 @@ class SpheroLibrary:
         self.shared_resources = SharedResources(sphero_config)
         self.shared_resources.get_numpy_resources()
 
-    def get_sphero_states(self):
+    def get_sphero_states(self, sphero_num=None, out=None, modalities=None, history=None):
         rgb_state = np.random.randint(0, 255, self.shared_resources.resources["np_array_rgb"].shape).astype(np.uint8)
         depth_state = np.random.randint(0, 255, self.shared_resources.resources["np_array_depth"].shape).astype(np.uint16)
         audio_state = np.random.uniform(0, 1, self.shared_resources.resources["np_array_audio"].shape)
@@ -20,8 +21,56 @@ class SpheroLibrary:
             "audio": audio_state}
         if self.shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"] > 0:
             state["spheros"] = np.random.uniform(0, 1, self.shared_resources.resources["np_array_sphero_states"].shape)
+            state["sphero_timestamps"] = self.shared_resources.resources["np_array_sphero_row_timestamps"].copy()
+        if modalities is not None:
+            state = {key: value for key, value in state.items() if key in modalities or
+                     (key == "sphero_timestamps" and "spheros" in modalities)}
+        if history is not None:
+            for key, value in state.items():
+                if key in ["spheros", "sphero_timestamps"]:
+                    state[key] = value[:, :history]
+                elif key == "audio":
+                    state[key] = value[-history * self.shared_resources.sphero_config["AUDIO_BYTES_PER_SAMPLE"]:]
+                else:
+                    state[key] = value[-history:]
         timestamps = self.shared_resources.resources["np_array_timestamps"].copy()
+        if out is not None:
+            [np.copyto(out[key], value) for key, value in state.items()]
+            np.copyto(out["timestamps"], timestamps)
+            timestamps = out["timestamps"]
+            state = {key: value for key, value in out.items() if key != "timestamps"}
         return state, timestamps
 
+    def allocate_state_buffers(self, modalities=None, history=None):
+        state, timestamps = self.get_sphero_states(modalities=modalities, history=history)
+        out = {key: np.empty_like(value) for key, value in state.items()}
+        out["timestamps"] = np.empty_like(timestamps)
+        return out
+
+    def wait_for_update(self, modality, since=None, timeout=None, sphero_num=0):
+        return 1 if since is None else since + 1
+
+    def iter_updates(self, modality, sphero_num=0, timeout=None, history=1):
+        generation = None
+        while True:
+            generation = self.wait_for_update(modality, since=generation, timeout=timeout, sphero_num=sphero_num)
+            state, timestamps = self.get_sphero_states(modalities=[modality], history=history)
+            yield generation, state, timestamps
+
     def set_sphero_action(self, spheroNum, spheroHeading, spheroSpeed):
         return True
+
+    def get_stream_rates(self):
+        return dict()
+
+    def get_sphero_health(self):
+        return np.full(self.shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"], SPHERO_READY, dtype=np.int8)
+
+    def sphero_available(self, sphero_num):
+        return True
+
+    def get_state_trace(self):
+        return []
+
+    def get_state_durations(self):
+        return {STATE_NAMES[state]: 0. for state in STATES}
@@ -1,19 +1,34 @@
 """
 A script to test functionality of the robot system via unit tests.
 """
-from SpheroLib.Lib.config import sphero_config
-from SpheroLib.Lib.sphero_library import SpheroLibrary
+from SpheroLib.config import sphero_config
+from SpheroLib.sphero_library import SpheroLibrary
+from SpheroLib.scheduler import Scheduler
+from SpheroLib.sphero_protocol import PacketDecoder, SensorResponseDecoder, Frame, escape, checksum, command_name, \
+    SENSOR_RESPONSE_VARIABLES, SENSOR_RESPONSE_SCALES
+from SpheroLib.sphero_bluetooth import SpheroDevice, CHARACTERISTIC_CACHE
+from SpheroLib.bluetooth_constants import APIConstants, DeviceId, SensorCommandIds, Flags, APIV2_CHARACTERISTIC
+from SpheroLib.shared_resources import SharedResources
+from SpheroLib.log_ring import log_message, log_header, drain_log_records
+from SpheroLib.sensor_monitor import run_sensor_monitor
+from SpheroLib.sphero_manager import SpheroManager
+from SpheroLib.state_machine import run_state_machine, RUNNING
+import multiprocessing as mp
+import threading
+import struct
 import time
 import cv2
 import numpy as np
 from scipy.io.wavfile import write
 import random
 import os
+import signal
 import subprocess
 from pathlib import Path
 import shutil
 import json
 import matplotlib.pyplot as plt
+import gatt
 
 
 def sensor_latency_test():
@@ -181,6 +196,7 @@ def robot_pushing_dataset_test(num_pushes, dataset_path):
     """
     sphero_lib = SpheroLibrary(sphero_config)
     output = sphero_lib.get_sphero_states()
+    calm_buffers = sphero_lib.allocate_state_buffers(modalities=["spheros"], history=1)
     print("Connected, beginning unit tests.")
     start_time = time.time()
     # Delete the dataset if it exists
@@ -239,7 +255,8 @@ def robot_pushing_dataset_test(num_pushes, dataset_path):
             calm = False
             calm_start = time.time()
             while not calm:
-                [state, timestamps] = sphero_lib.get_sphero_states()
+                [state, timestamps] = sphero_lib.get_sphero_states(out=calm_buffers, modalities=["spheros"],
+                                                                   history=1)
                 current_state = state["spheros"][sphero_num][0]
                 speed = (current_state[3] ** 2 + current_state[4] ** 2) ** .5
                 rotation = (current_state[5] ** 2 + current_state[6] ** 2 + current_state[7] ** 2) ** .5
@@ -292,6 +309,596 @@ def robot_trajectory_test():
     print(f"[Audio Visual Robot Test] Robot movie saved to ../movie.mp4")
     print("-" * 50)
 
+def process_cpu_seconds(pid):
+    """
+    (user + system cpu seconds, voluntary context switches) used so far by a process.
+    Voluntary context switches are roughly the number of times it went to sleep and woke up.
+    """
+    with open(f"/proc/{pid}/stat") as stat_file:
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    with open(f"/proc/{pid}/status") as status_file:
+        wakeups = [int(line.split()[1]) for line in status_file if line.startswith("voluntary_ctxt_switches")][0]
+    return cpu_seconds, wakeups
+
+
+def descendant_pids(root_pid):
+    """
+    Every live process below root_pid, found through /proc/<pid>/stat parent pids.
+    """
+    children = dict()
+    for pid in [pid for pid in os.listdir('/proc') if pid.isdigit()]:
+        try:
+            with open(f"/proc/{pid}/stat") as stat_file:
+                parent = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+            children.setdefault(parent, []).append(int(pid))
+        except IOError:  # proc has already terminated
+            continue
+    pids, frontier = [], [root_pid]
+    while frontier:
+        pid = frontier.pop()
+        pids += children.get(pid, [])
+        frontier += children.get(pid, [])
+    return pids
+
+
+def measure_cpu_usage(pids, duration):
+    """
+    Average cpu % and wakeups/sec of each pid over duration seconds.
+    """
+    start = {pid: process_cpu_seconds(pid) for pid in pids}
+    time.sleep(duration)
+    usage = dict()
+    for pid in pids:
+        try:
+            end = process_cpu_seconds(pid)
+        except IOError:  # proc has already terminated
+            continue
+        usage[pid] = (100 * (end[0] - start[pid][0]) / duration, (end[1] - start[pid][1]) / duration)
+    return usage
+
+
+def library_cpu_usage_test(duration=30):
+    """
+    Cpu % and wakeups/sec of every library process, first with the library idle and then while
+    this process polls states and sends actions as fast as it can. Run before/after a change to
+    compare the library's overhead.
+    """
+    sphero_lib = SpheroLibrary(sphero_config)
+    output = sphero_lib.get_sphero_states()
+    print("Connected, beginning unit tests.")
+    pids = descendant_pids(os.getpid())
+    names = {pid: open(f"/proc/{pid}/cmdline").read().replace("\0", " ")[:60] for pid in pids}
+
+    print(f"[CPU Usage Test] Library idle for {duration} seconds")
+    idle_usage = measure_cpu_usage(pids, duration)
+
+    print(f"[CPU Usage Test] Library under load for {duration} seconds")
+    stop = time.time() + duration
+
+    def load():
+        while time.time() < stop:
+            sphero_lib.get_sphero_states()
+            for sphero_num in range(sphero_config["SIMULTANEOUS_SPHEROS"]):
+                sphero_lib.set_sphero_action(sphero_num, random.randint(0, 359), 0)
+
+    threading.Thread(target=load, daemon=True).start()
+    load_usage = measure_cpu_usage(pids, duration)
+
+    for label, usage in [("idle", idle_usage), ("load", load_usage)]:
+        print(f"[CPU Usage Test] {label}: total {sum(cpu for cpu, _ in usage.values()):.1f}% cpu, "
+              f"{sum(wakeups for _, wakeups in usage.values()):.0f} wakeups/sec")
+        for pid, (cpu, wakeups) in usage.items():
+            print(f"    {pid} {names[pid]}: {cpu:.1f}% cpu, {wakeups:.0f} wakeups/sec")
+    print("-" * 50)
+
+
+def sleep_polling_worker(flag):
+    while flag.value == 0:
+        time.sleep(.001)
+
+
+def condition_waiting_worker(flag, condition):
+    with condition:
+        condition.wait_for(lambda: flag.value != 0)
+
+
+def polling_cpu_benchmark(duration=5):
+    """
+    No hardware needed. Idle cost of one process waiting on a flag by sleep-polling every 1ms (how the
+    library processes used to wait) vs blocking on an mp.Condition (how they wait now).
+    """
+    flag = mp.Value('i')
+    condition = mp.Condition()
+    procs = {"sleep polling": mp.Process(target=sleep_polling_worker, args=(flag,)),
+             "condition wait": mp.Process(target=condition_waiting_worker, args=(flag, condition))}
+    [proc.start() for proc in procs.values()]
+    time.sleep(.5)
+    usage = measure_cpu_usage([proc.pid for proc in procs.values()], duration)
+    with condition:
+        flag.value = 1
+        condition.notify_all()
+    [proc.join() for proc in procs.values()]
+    for name, proc in procs.items():
+        cpu, wakeups = usage[proc.pid]
+        print(f"[Polling Benchmark] {name}: {cpu:.2f}% cpu, {wakeups:.0f} wakeups/sec")
+    print("-" * 50)
+
+
+def synthetic_notifications(num_packets, notification_size=20):
+    """
+    Sensor response packets with random float data (so escaped bytes show up), cut into BLE sized
+    notifications.
+    """
+    stream = bytearray()
+    for seq in range(num_packets):
+        body = bytes([Flags["isResponse"] | Flags["resetsInactivityTimeout"], DeviceId["sensor"],
+                      SensorCommandIds["sensorResponse"], seq % 256])
+        body += np.random.uniform(-180, 180, 13).astype(">f4").tobytes()
+        body += bytes([checksum(body)])
+        stream += bytes([APIConstants["startOfPacket"]]) + escape(body) + bytes([APIConstants["endOfPacket"]])
+    return [bytes(stream[i:i + notification_size]) for i in range(0, len(stream), notification_size)]
+
+
+def legacy_decode_notifications(notifications):
+    """
+    The per-byte state machine SpheroDevice.on_value_change used before PacketDecoder, for comparison.
+    """
+    packets = []
+    packet = []
+    escaped = False
+    for value in notifications:
+        for val in value:
+            if val == APIConstants["startOfPacket"]:
+                packet = [val]
+                escaped = False
+            elif val == APIConstants["endOfPacket"]:
+                if len(packet) < 6:
+                    continue
+                packet.append(val)
+                if (~sum(packet[1:-2]) & 0xff) != packet[-2]:
+                    continue
+                packets.append(packet)
+            elif val == APIConstants["escape"]:
+                escaped = True
+            elif val in [APIConstants["escapedEscape"], APIConstants["escapedStartOfPacket"],
+                         APIConstants["escapedEndOfPacket"]]:
+                if escaped:
+                    val = val | APIConstants["escapeMask"]
+                    escaped = False
+                packet.append(val)
+            elif not escaped:
+                packet.append(val)
+    return packets
+
+
+def packet_decoder_benchmark(capture_path=None, num_packets=20000):
+    """
+    No hardware needed. Throughput of reassembling packets from BLE notifications, old per-byte decoder vs
+    PacketDecoder. Uses a capture recorded with SPHERO_NOTIFICATION_CAPTURE if given, else synthetic
+    sensor packets.
+    """
+    if capture_path is not None:
+        with open(capture_path) as capture_file:
+            notifications = [bytes.fromhex(line.strip()) for line in capture_file if line.strip()]
+    else:
+        notifications = synthetic_notifications(num_packets)
+    num_bytes = sum(len(value) for value in notifications)
+
+    start_time = time.perf_counter()
+    legacy_packets = legacy_decode_notifications(notifications)
+    legacy_time = time.perf_counter() - start_time
+
+    decoder = PacketDecoder()
+    start_time = time.perf_counter()
+    packets = [packet for value in notifications for packet in decoder.feed(value)]
+    decoder_time = time.perf_counter() - start_time
+
+    assert [list(packet) for packet in packets] == legacy_packets, "Decoders disagree"
+    for name, elapsed in [("per-byte", legacy_time), ("PacketDecoder", decoder_time)]:
+        print(f"[Decoder Benchmark] {name}: {len(packets) / elapsed:.0f} packets/sec, "
+              f"{num_bytes / elapsed / 1e6:.2f} MB/sec")
+    print(f"[Decoder Benchmark] Speedup {legacy_time / decoder_time:.1f}x, stats {decoder.stats}")
+    print("-" * 50)
+
+
+def legacy_sensor_row(data, output_variables):
+    """
+    How SpheroDevice.handle_sensor_update built a state row before SensorResponseDecoder, for comparison.
+    """
+    sensor_vals = dict()
+    for offset, variable in enumerate(SENSOR_RESPONSE_VARIABLES):
+        sensor_vals[variable] = struct.unpack('>f', bytearray(data[offset * 4:offset * 4 + 4]))[0] * \
+            SENSOR_RESPONSE_SCALES.get(variable, 1.)
+    for key, value in sensor_vals.items():
+        if np.isnan(value):
+            return None
+    return np.array([sensor_vals[var] for var in output_variables])
+
+
+def sensor_decode_benchmark(num_packets=100000):
+    """
+    No hardware needed. Per packet cost of turning sensor response data into a row of the shared sphero ring
+    buffer, old per-float decoding vs SensorResponseDecoder.
+    """
+    output_variables = sphero_config["SPHERO_OUTPUT_VARIABLES"]
+    decoder = SensorResponseDecoder(output_variables)
+    ring = np.zeros([sphero_config["SPHERO_LENGTH_STATE"], len(output_variables)], dtype=np.float32)
+    packets = [np.random.uniform(-180, 180, len(SENSOR_RESPONSE_VARIABLES)).astype(">f4").tobytes()
+               for _ in range(1000)]
+    legacy_packets = [list(packet) for packet in packets]
+
+    start_time = time.perf_counter()
+    for elt in range(num_packets):
+        ring[elt % len(ring)] = legacy_sensor_row(legacy_packets[elt % len(packets)], output_variables)
+    legacy_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for elt in range(num_packets):
+        ring[elt % len(ring)] = decoder.decode(packets[elt % len(packets)])
+    decoder_time = time.perf_counter() - start_time
+
+    for packet, legacy_packet in zip(packets[:10], legacy_packets):
+        assert np.array_equal(np.float32(decoder.decode(packet)),
+                              np.float32(legacy_sensor_row(legacy_packet, output_variables))), "Decoders disagree"
+    for name, elapsed in [("per-float", legacy_time), ("SensorResponseDecoder", decoder_time)]:
+        print(f"[Sensor Decode Benchmark] {name}: {elapsed / num_packets * 1e6:.2f} us/packet")
+    print("-" * 50)
+
+
+def timer_heartbeat_worker(num_devices, period, beats, stop):
+    def beat():
+        beats.value += 1
+        if not stop.value:
+            threading.Timer(period, beat).start()
+
+    [threading.Timer(period, beat).start() for _ in range(num_devices)]
+    while not stop.value:
+        time.sleep(.1)
+
+
+def scheduler_heartbeat_worker(num_devices, period, beats, stop):
+    scheduler = Scheduler()
+
+    def beat():
+        beats.value += 1
+        if not stop.value:
+            scheduler.call_later(period, beat)
+
+    [scheduler.call_later(period, beat) for _ in range(num_devices)]
+    while not stop.value:
+        time.sleep(.1)
+
+
+def heartbeat_scheduler_benchmark(num_devices=8, period=.01, duration=5):
+    """
+    No hardware needed. Cost of num_devices self re-arming callbacks every period seconds (heartbeats and
+    action retries) as a new threading.Timer thread per call, how the sphero processes used to run them,
+    vs on one Scheduler thread.
+    """
+    stop = mp.Value('i')
+    beats = {"threading.Timer": mp.Value('l'), "Scheduler": mp.Value('l')}
+    procs = {"threading.Timer": mp.Process(target=timer_heartbeat_worker,
+                                           args=(num_devices, period, beats["threading.Timer"], stop)),
+             "Scheduler": mp.Process(target=scheduler_heartbeat_worker,
+                                     args=(num_devices, period, beats["Scheduler"], stop))}
+    [proc.start() for proc in procs.values()]
+    time.sleep(.5)
+    start_beats = {name: value.value for name, value in beats.items()}
+    usage = measure_cpu_usage([proc.pid for proc in procs.values()], duration)
+    stop.value = 1
+    [proc.join() for proc in procs.values()]
+    for name, proc in procs.items():
+        cpu, _ = usage[proc.pid]
+        rate = (beats[name].value - start_beats[name]) / duration
+        threads = rate if name == "threading.Timer" else 0
+        print(f"[Heartbeat Benchmark] {name}: {cpu:.2f}% cpu, {rate:.0f} callbacks/sec "
+              f"(target {num_devices / period:.0f}), {threads:.0f} threads started/sec")
+    print("-" * 50)
+
+
+def legacy_log_consumer(logging_queue, path):
+    """
+    The logger as it was: one blocking get and one flushed line per message.
+    """
+    with open(path, "w") as log_file:
+        while True:
+            message = logging_queue.get()
+            if message is None:
+                return
+            log_file.write("{} | {} \n".format(time.ctime(time.time()), message))
+            log_file.flush()
+
+
+def log_ring_consumer(shared_resources, path, stop):
+    shared_resources.get_numpy_resources()
+    with open(path, "wb") as log_file:
+        log_file.write(log_header(shared_resources.sphero_config))
+        while not stop.value:
+            time.sleep(shared_resources.sphero_config["LOG_FLUSH_SECS"])
+            log_file.write(drain_log_records(shared_resources).tobytes())
+            log_file.flush()
+
+
+def log_ring_benchmark(num_messages=2000, burst=100, path="/tmp/log_benchmark"):
+    """
+    No hardware needed. Time a sphero callback spends logging, in bursts of burst messages, through the
+    old logging_queue (maxsize 10, flushed per line) vs the shared memory log ring.
+    """
+    message = "[Heartbeat] Sphero lost sensor stream"
+
+    def time_calls(log):
+        timings = []
+        for elt in range(num_messages):
+            start = time.perf_counter()
+            log(message)
+            timings.append(time.perf_counter() - start)
+            if elt % burst == burst - 1:
+                time.sleep(.1)
+        return np.array(timings)
+
+    logging_queue = mp.Queue(maxsize=10)
+    consumer = mp.Process(target=legacy_log_consumer, args=(logging_queue, path + ".txt"))
+    consumer.start()
+    legacy_timings = time_calls(logging_queue.put)
+    logging_queue.put(None)
+    consumer.join()
+
+    shared_resources = SharedResources(dict(sphero_config, SHARED_MEMORY_NAME="log_ring_benchmark"))
+    stop = mp.Value('i')
+    consumer = mp.Process(target=log_ring_consumer, args=(shared_resources, path + ".log", stop))
+    consumer.start()
+    ring_timings = time_calls(lambda text: log_message(shared_resources, "sphero0", text))
+    stop.value = 1
+    consumer.join()
+    dropped = int(shared_resources.resources["np_array_log_dropped"].sum())
+    shared_resources.unlink()
+
+    for name, timings in [("logging_queue", legacy_timings), ("log ring", ring_timings)]:
+        print(f"[Log Benchmark] {name}: mean {timings.mean() * 1e6:.1f}us, "
+              f"p99 {np.percentile(timings, 99) * 1e6:.1f}us, max {timings.max() * 1e6:.1f}us per message")
+    print(f"[Log Benchmark] log ring dropped {dropped} of {num_messages} "
+          f"(ring of {sphero_config['LOG_RING_LENGTH']})")
+    print("-" * 50)
+
+
+class OfflineDevice(gatt.Device):
+    """
+    Stands in for the gatt connection under a SpheroDevice, so its logic runs without bluetooth.
+    """
+
+    def __init__(self, mac_address, manager):
+        self.mac_address = mac_address
+        self.services = []
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def connect_succeeded(self):
+        pass
+
+    def services_resolved(self):
+        pass
+
+
+class OfflineSpheroDevice(SpheroDevice, OfflineDevice):
+    """
+    SpheroDevice over OfflineDevice. Commands written to the API characteristic are recorded by name in
+    writes, and acked after write_ack_secs.
+    """
+
+    def __init__(self, shared_resources, sphero_num=0, write_ack_secs=.01):
+        self.writes = []
+        self.write_ack_secs = write_ack_secs
+        super().__init__(shared_resources, f"offline{sphero_num}", None, sphero_num, mp.Value('i'), Scheduler())
+        self.cancel_scheduled_calls()
+        self.offline_decoder = PacketDecoder()
+
+    def write_value(self, charac, value):
+        if charac == APIV2_CHARACTERISTIC:
+            self.writes += [command_name(frame.deviceId, frame.commandId)
+                            for frame in map(Frame, self.offline_decoder.feed(value))]
+        self.scheduler.call_later(self.write_ack_secs, self.characteristic_write_value_succeeded, None)
+
+    def connect(self):
+        self.scheduler.call_later(self.write_ack_secs, self.connect_succeeded)
+
+
+class OfflineCharacteristic:
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+    def enable_notifications(self):
+        pass
+
+
+def action_retry_ordering_test(yaw_ack_secs=.65, write_ack_secs=.3):
+    """
+    No hardware needed. Run one action whose reset yaw is only acked after yaw_ack_secs, over writes slower
+    than SPHERO_ACTION_RETRY_SECS so retries queue up, and check no reset yaw is written after the drive command.
+    """
+    shared_resources = SharedResources(dict(sphero_config, SHARED_MEMORY_NAME="action_retry_test"))
+    device = OfflineSpheroDevice(shared_resources, write_ack_secs=write_ack_secs)
+    actions = shared_resources.resources["np_array_sphero_actions"][0]
+    actions[:] = [90, 50, 1]
+    device.run_action()
+    time.sleep(yaw_ack_secs)
+    device.on_reset_yaw()
+    time.sleep(.1)
+    device.on_roll()
+    time.sleep(4 * write_ack_secs)
+    shared_resources.unlink()
+    print(f"[Action Retry Test] Writes: {device.writes}")
+    drive = device.writes.index("driving.driveWithHeading")
+    assert "driving.resetYaw" not in device.writes[drive:], "A reset yaw was written after the drive command"
+    print("-" * 50)
+
+
+def stream_rate_test(num_updates=100):
+    """
+    No hardware needed. Feed the rgb stream's rate tracking one tiny interval, like a frame delivered
+    straight after the first, then intervals at CAMERA_FPS, and check the measured rate settles on CAMERA_FPS.
+    """
+    shared_resources = SharedResources(dict(sphero_config, SHARED_MEMORY_NAME="stream_rate_test"))
+    timestamps = [1000., 1000.0005] + [1000.0005 + elt / sphero_config["CAMERA_FPS"] for elt in range(1, num_updates)]
+    for timestamp in timestamps:
+        shared_resources.resources["np_array_timestamps"][0] = timestamp
+        shared_resources.update_stream_rate(0)
+    rate = 1 / shared_resources.resources["np_array_stream_rates"][0, 1]
+    shared_resources.unlink()
+    print(f"[Stream Rate Test] Measured {rate:.1f}hz, expected {sphero_config['CAMERA_FPS']}hz")
+    assert abs(rate - sphero_config["CAMERA_FPS"]) < 1, "One early interval pinned the measured rate"
+    print("-" * 50)
+
+
+def cached_reconnect_test():
+    """
+    No hardware needed. Reconnect a sphero whose characteristics are cached, and check it is woken as
+    soon as it connects rather than at the start stage's 1s deadline.
+    """
+    shared_resources = SharedResources(dict(sphero_config, SHARED_MEMORY_NAME="cached_reconnect_test"))
+    device = OfflineSpheroDevice(shared_resources)
+    CHARACTERISTIC_CACHE[device.mac_address] = {APIV2_CHARACTERISTIC: OfflineCharacteristic(APIV2_CHARACTERISTIC)}
+    start_time = time.time()
+    device.reconnect()
+    while "powerInfo.wake" not in device.writes and time.time() - start_time < 2:
+        time.sleep(.001)
+    wake_time = time.time() - start_time
+    device.cancel_scheduled_calls()
+    CHARACTERISTIC_CACHE.pop(device.mac_address)
+    shared_resources.unlink()
+    print(f"[Cached Reconnect Test] Wake sent {wake_time * 1000:.1f}ms after reconnecting")
+    assert wake_time < .5, "The cached reconnect waited for the start stage deadline"
+    print("-" * 50)
+
+
+def update_waiting_worker(shared_resources, stream):
+    shared_resources.get_numpy_resources()
+    shared_resources.wait_for_update(stream, int(shared_resources.resources["np_array_packet_counters"][stream]))
+
+
+def killed_waiter_test(num_writes=100):
+    """
+    No hardware needed. SIGKILL a process while it waits in wait_for_update, then check end_write still
+    returns promptly and a live waiter still wakes on the next write.
+    """
+    shared_resources = SharedResources(dict(sphero_config, SHARED_MEMORY_NAME="killed_waiter_test"))
+
+    def publish():
+        shared_resources.begin_write(0)
+        shared_resources.resources["np_array_timestamps"][0] = time.time()
+        shared_resources.resources["np_array_packet_counters"][0] += 1
+        shared_resources.end_write(0)
+
+    waiter = mp.Process(target=update_waiting_worker, args=(shared_resources, 0))
+    waiter.start()
+    time.sleep(.5)
+    os.kill(waiter.pid, signal.SIGKILL)
+    waiter.join()
+    timings = []
+    for _ in range(num_writes):
+        start = time.perf_counter()
+        publish()
+        timings.append(time.perf_counter() - start)
+
+    since = int(shared_resources.resources["np_array_packet_counters"][0])
+    threading.Timer(.1, publish).start()
+    start = time.time()
+    woken = shared_resources.wait_for_update(0, since, timeout=2)
+    wake_time = time.time() - start
+    shared_resources.unlink()
+    print(f"[Killed Waiter Test] end_write max {max(timings) * 1000:.3f}ms after the waiter was killed, "
+          f"live waiter woken after {wake_time * 1000:.1f}ms")
+    assert max(timings) < .05, "end_write waited on the killed waiter"
+    assert woken == since + 1 and wake_time < .5, "The live waiter was not woken by the write"
+    print("-" * 50)
+
+
+def zero_sphero_test(timeout=5):
+    """
+    No hardware needed. Run the sensor monitor, state machine and sphero manager for a camera and audio
+    only arena, fed with fake frames and audio blocks, and check the library gets to running.
+    """
+    shared_resources = SharedResources(dict(sphero_config, SIMULTANEOUS_SPHEROS=0,
+                                            SHARED_MEMORY_NAME="zero_sphero_test"))
+    procs = [mp.Process(target=target, args=(shared_resources,), daemon=True)
+             for target in [run_state_machine, run_sensor_monitor, SpheroManager]]
+    [proc.start() for proc in procs]
+    counters = shared_resources.resources["np_array_packet_counters"]
+    start_time = time.time()
+    while shared_resources.resources["library_state"].value != RUNNING and time.time() - start_time < timeout:
+        for stream in range(3):
+            shared_resources.begin_write(stream)
+            shared_resources.resources["np_array_timestamps"][stream] = time.time()
+            counters[stream] = max(counters[stream] + 1, sphero_config["AUDIO_LENGTH_STATE"],
+                                   sphero_config["CAMERA_LENGTH_STATE"])
+            shared_resources.end_write(stream)
+        time.sleep(1 / sphero_config["CAMERA_FPS"])
+    state = shared_resources.resources["library_state"].value
+    running_time = time.time() - start_time
+    # The manager has no workers to start, give it a moment to fail at that
+    time.sleep(.5)
+    alive = all(proc.is_alive() for proc in procs)
+    [proc.terminate() for proc in procs]
+    shared_resources.unlink()
+    print(f"[Zero Sphero Test] Library state {state} after {running_time:.1f}s")
+    assert alive, "A library process died with no spheros"
+    assert state == RUNNING, "The library never got to running with no spheros"
+    print("-" * 50)
+
+
+def state_alignment_test():
+    """
+    No hardware needed. Fill the buffers with numbered frames, audio blocks and sphero rows whose values
+    are their capture times, then check get_state_at and get_states_between pick the rgb and depth
+    frame at or before each time, the audio block recorded over it, and interpolate the spheros to it.
+    """
+    config = dict(sphero_config, SIMULTANEOUS_SPHEROS=1, SHARED_MEMORY_NAME="state_alignment_test")
+    shared_resources = SharedResources(config)
+    resources = shared_resources.resources
+    # Full rings starting at start_time, oldest in slot 0, numbered by slot
+    start_time = 10.
+    frame_period = 1 / config["CAMERA_FPS"]
+    for modality in ["rgb", "depth"]:
+        num_frames = len(resources[f"np_array_{modality}_timestamps"])
+        resources[f"np_array_{modality}_timestamps"][:] = start_time + np.arange(num_frames) * frame_period
+        resources[f"np_array_{modality}"][:] = (np.arange(num_frames) % 256).reshape(
+            (-1,) + (1,) * (resources[f"np_array_{modality}"].ndim - 1))
+    num_blocks = len(resources["np_array_audio_timestamps"])
+    block_secs = config["AUDIO_SECS_PER_SAMPLE"]
+    resources["np_array_audio_timestamps"][:] = start_time + (np.arange(num_blocks) + 1) * block_secs
+    resources["np_array_audio_blocks"][:] = np.arange(num_blocks).reshape(-1, 1, 1)
+    sphero_times = start_time + np.arange(config["SPHERO_LENGTH_STATE"], dtype=np.float64)
+    resources["np_array_sphero_row_timestamps"][0] = sphero_times
+    resources["np_array_sphero_states"][0] = sphero_times[:, None]
+    shared_resources.set_library_state(RUNNING)
+
+    library = SpheroLibrary.__new__(SpheroLibrary)
+    library.shared_resources = shared_resources
+    state = library.get_state_at(start_time + 9.5)
+    assert np.allclose(state["spheros"][0], start_time + 9.5), \
+        f"Sphero rows not interpolated, got {state['spheros'][0, 0]}"
+    state = library.get_state_at(start_time + 10.5 * block_secs)
+    assert state["audio"][0, 0] == 10, f"Wrong audio block, got {state['audio'][0, 0]} instead of 10"
+    state = library.get_state_at(start_time + 5.5 * frame_period)
+    assert state["rgb"].flat[0] == 5 and state["depth"].flat[0] == 5, \
+        f"Wrong frames, got rgb {state['rgb'].flat[0]} and depth {state['depth'].flat[0]} instead of 5"
+    state = library.get_state_at(start_time - 1)
+    assert state["rgb"] is None and state["depth"] is None and state["audio"] is None, \
+        "Frames or audio returned from before anything was captured"
+
+    clock = start_time + np.array([2.5, 3.25, 7.75]) * frame_period
+    state = library.get_states_between(start_time, start_time + 1, clock=clock)
+    assert state["rgb"][:, 0, 0, 0].tolist() == [2, 3, 7], f"Wrong frames for clock, got {state['rgb'][:, 0, 0, 0]}"
+    assert np.allclose(state["spheros"][0, :, 0], clock), "Sphero rows not interpolated to the clock"
+    shared_resources.unlink()
+    print("[State Alignment Test] Passed")
+    print("-" * 50)
+
+
 if __name__ == "__main__":
     # import multiprocessing as mp
     # mp.set_start_method("spawn")
@@ -302,4 +909,16 @@ if __name__ == "__main__":
     # audio_visual_robot_test()
     # robot_pushing_dataset_test(num_pushes=100, dataset_path="../test_dataset")
     # yaw_consistency_test()
-    # robot_trajectory_test()
\ No newline at end of file
+    # robot_trajectory_test()
+    # library_cpu_usage_test()
+    # polling_cpu_benchmark()
+    # packet_decoder_benchmark()
+    # sensor_decode_benchmark()
+    heartbeat_scheduler_benchmark()
+    # log_ring_benchmark()
+    # action_retry_ordering_test()
+    # stream_rate_test()
+    # cached_reconnect_test()
+    # killed_waiter_test()
+    # zero_sphero_test()
+    # state_alignment_test()
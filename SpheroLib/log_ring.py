@@ -0,0 +1,173 @@
+"""
+Non-blocking logging through shared memory.
+
+Every log source (library process, or sphero) has its own ring of fixed size records in the shared
+segment: time, code and args. The source writes, the logger reads, so neither ever waits on the other.
+A full ring drops the record and counts it in np_array_log_dropped rather than block its writer.
+Args too long for one record spill into LOG_CONTINUED records right behind it, up to LOG_MAX_RECORDS
+in all. Past that they are cut short and end in LOG_TRUNCATED_MARK.
+Threads of one process that share a source take a lock the logger never touches.
+
+The logger appends the records to Logs/Library.log in batches: one json header line describing
+sources and codes, then LOG_RECORD_DTYPE records. Decode it with
+
+    python -m SpheroLib.log_ring [log file] [source]
+"""
+
+import numpy as np
+import json
+import os
+import sys
+import threading
+import time
+
+LOG_ARGS_BYTES = 120
+# Records one log call can take, and what ends args cut short to fit in them
+LOG_MAX_RECORDS = 8
+LOG_TRUNCATED_MARK = b"...[truncated]"
+# Processes that log, followed by one source per sphero ("sphero<n>")
+LOG_SOURCES = ["library", "logger", "state_machine", "sensor_monitor", "camera", "microphone", "sphero_manager"]
+LOG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../Logs/Library.log"))
+
+# Message templates, indexed by a record's code. A record's args fill in the template's {}.
+LOG_TEXT = 0
+LOG_SENSOR_PACKET_INCOMPLETE = 1
+LOG_SENSOR_NANS = 2
+LOG_WRITE_FAILED = 3
+LOG_DROPPED = 4
+LOG_CONTINUED = 5
+LOG_CODES = ["{}",
+             "[Handle sensor update] Sensor data packet incomplete: {} bytes",
+             "[handle_sensor_update] WE HAVE NANS",
+             "[Write Val Failed] {}",
+             "[Logger] Dropped {} records from {}",
+             "{}"]
+# Separates args in a record
+LOG_ARGS_SEPARATOR = "\x1f"
+
+LOG_RECORD_DTYPE = np.dtype([("time", "<f8"), ("source", "<u2"), ("code", "<u2"), ("args", f"S{LOG_ARGS_BYTES}")])
+
+# Per process writer locks, by source row. A fork can copy one held by another thread, so the child starts over.
+LOG_LOCKS = dict()
+os.register_at_fork(after_in_child=LOG_LOCKS.clear)
+
+
+def log_sources(sphero_config):
+    """
+    Every log source, in the row order of the shared log rings.
+    """
+    return LOG_SOURCES + [f"sphero{sphero_elt}" for sphero_elt in range(sphero_config["SIMULTANEOUS_SPHEROS"])]
+
+
+def log_event(shared_resources, source, code, *args):
+    """
+    Add a record to source's ring, plus LOG_CONTINUED records for args that don't fit in one. Never
+    blocks: if the logger has fallen too far behind to take them all, they are dropped and counted.
+    """
+    if shared_resources.read_only:
+        return
+    resources = shared_resources.resources
+    row = shared_resources.log_rows[source]
+    payload = LOG_ARGS_SEPARATOR.join(str(arg) for arg in args).encode()
+    if len(payload) > LOG_ARGS_BYTES * LOG_MAX_RECORDS:
+        payload = payload[:LOG_ARGS_BYTES * LOG_MAX_RECORDS - len(LOG_TRUNCATED_MARK)] + LOG_TRUNCATED_MARK
+    chunks = [payload[start:start + LOG_ARGS_BYTES] for start in range(0, len(payload), LOG_ARGS_BYTES)] or [b""]
+    ring_length = resources["np_array_log_times"].shape[1]
+    with LOG_LOCKS.setdefault(row, threading.Lock()):
+        written = resources["np_array_log_write_counters"][row]
+        if written + len(chunks) - resources["np_array_log_read_counters"][row] > ring_length:
+            resources["np_array_log_dropped"][row] += len(chunks)
+            return
+        now = time.time()
+        for elt, chunk in enumerate(chunks):
+            slot = (written + elt) % ring_length
+            resources["np_array_log_times"][row, slot] = now
+            resources["np_array_log_codes"][row, slot] = LOG_CONTINUED if elt else code
+            resources["np_array_log_args"][row, slot] = chunk
+        # Publish the records only once they are all complete, so the logger never splits them up
+        resources["np_array_log_write_counters"][row] = written + len(chunks)
+
+
+def log_message(shared_resources, source, message):
+    log_event(shared_resources, source, LOG_TEXT, message)
+
+
+def drain_log_records(shared_resources):
+    """
+    Take every published record out of the rings. Only the logger calls this.
+    Returns a LOG_RECORD_DTYPE array, oldest first.
+    """
+    resources = shared_resources.resources
+    ring_length = resources["np_array_log_times"].shape[1]
+    batches = []
+    for row, written in enumerate(resources["np_array_log_write_counters"].copy()):
+        read = resources["np_array_log_read_counters"][row]
+        if written == read:
+            continue
+        slots = np.arange(read, written) % ring_length
+        batch = np.empty(len(slots), dtype=LOG_RECORD_DTYPE)
+        batch["time"] = resources["np_array_log_times"][row, slots]
+        batch["source"] = row
+        batch["code"] = resources["np_array_log_codes"][row, slots]
+        batch["args"] = resources["np_array_log_args"][row, slots]
+        batches.append(batch)
+        # Hand the slots back to the writer only once they are copied
+        resources["np_array_log_read_counters"][row] = written
+    if not batches:
+        return np.empty(0, dtype=LOG_RECORD_DTYPE)
+    records = np.concatenate(batches)
+    return records[np.argsort(records["time"], kind="stable")]
+
+
+def log_header(sphero_config):
+    """
+    First line of a log file, everything needed to decode its records.
+    """
+    return (json.dumps({"sources": log_sources(sphero_config), "codes": LOG_CODES,
+                        "record_dtype": LOG_RECORD_DTYPE.descr}) + "\n").encode()
+
+
+def read_log(path):
+    """
+    Header dict and LOG_RECORD_DTYPE records of a log file. A record still being written is left out.
+    """
+    with open(path, "rb") as log_file:
+        header = json.loads(log_file.readline())
+        data = log_file.read()
+    record_dtype = np.dtype([tuple(field) for field in header["record_dtype"]])
+    return header, np.frombuffer(data[:len(data) - len(data) % record_dtype.itemsize], dtype=record_dtype)
+
+
+def join_records(header, records):
+    """
+    Fold LOG_CONTINUED records back into the record they continue. Returns (record, args bytes) pairs.
+    """
+    # Logs from before continuations have no such code
+    continued = LOG_CONTINUED if len(header["codes"]) > LOG_CONTINUED else None
+    messages = []
+    # Last message of each source, the one its next continuation belongs to
+    latest = dict()
+    for record in records:
+        if record["code"] == continued and record["source"] in latest:
+            latest[record["source"]][1] += record["args"]
+        else:
+            messages.append([record, record["args"]])
+            latest[record["source"]] = messages[-1]
+    return messages
+
+
+def format_record(header, record, args=None):
+    args = (record["args"] if args is None else args).decode(errors="replace").split(LOG_ARGS_SEPARATOR)
+    message = header["codes"][record["code"]].format(*args)
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["time"])) + \
+        f".{int(record['time'] % 1 * 1000):03d}"
+    return f"{timestamp} | {header['sources'][record['source']]} | {message}"
+
+
+if __name__ == "__main__":
+    # python -m SpheroLib.log_ring [log file, default Logs/Library.log] [only this source, e.g. sphero0]
+    header, records = read_log(sys.argv[1] if len(sys.argv) > 1 else LOG_PATH)
+    if len(sys.argv) > 2:
+        records = records[records["source"] == header["sources"].index(sys.argv[2])]
+    for record, args in join_records(header, records):
+        print(format_record(header, record, args))
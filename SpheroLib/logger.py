@@ -1,28 +1,26 @@
+from SpheroLib.log_ring import LOG_PATH, LOG_DROPPED, log_event, log_sources, log_header, drain_log_records
 import os
 import time
 
 
 def run_logger(shared_resources):
     """
-    Log the library comings and goings to a log file
+    Log the library comings and goings to a log file. Every LOG_FLUSH_SECS, whatever the
+    sources have put in their log rings is written out in one go (see log_ring).
     """
     shared_resources.get_numpy_resources()
-    log_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../Logs/"))
-    if not os.path.exists(log_dir):
-        os.mkdir(log_dir)
-    sphero_log_path = f"{log_dir}/Spheros.txt"
-    library_log_path = f"{log_dir}/Library.txt"
-    sphero_log_file = open(sphero_log_path, "w+")
-    library_log_file = open(library_log_path, "w+")
-    while True:
-        time.sleep(.001)
-        message = shared_resources.resources["logging_queue"].get()
-        human_time = time.ctime(time.time())
-        if message[:7] == "[Sphero":
-            sphero_log_file.write("{} | {} \n".format(
-                human_time, message))
-            sphero_log_file.flush()
-        else:
-            library_log_file.write("{} | {} \n".format(
-                human_time, message))
-            library_log_file.flush()
+    os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
+    sources = log_sources(shared_resources.sphero_config)
+    dropped = shared_resources.resources["np_array_log_dropped"].copy()
+    with open(LOG_PATH, "wb") as log_file:
+        log_file.write(log_header(shared_resources.sphero_config))
+        while True:
+            time.sleep(shared_resources.sphero_config["LOG_FLUSH_SECS"])
+            new_dropped = shared_resources.resources["np_array_log_dropped"] - dropped
+            dropped += new_dropped
+            for row in new_dropped.nonzero()[0]:
+                log_event(shared_resources, "logger", LOG_DROPPED, new_dropped[row], sources[row])
+            records = drain_log_records(shared_resources)
+            if len(records):
+                log_file.write(records.tobytes())
+                log_file.flush()
@@ -0,0 +1,68 @@
+import math
+import numpy as np
+
+# Latency histograms have LATENCY_BINS_PER_DECADE log-spaced bins from LATENCY_MIN_SECS to
+# LATENCY_MAX_SECS, plus an underflow bin first and an overflow bin last.
+LATENCY_MIN_SECS = 1e-5
+LATENCY_MAX_SECS = 10.
+LATENCY_BINS_PER_DECADE = 10
+LATENCY_NUM_BINS = int(round(math.log10(LATENCY_MAX_SECS / LATENCY_MIN_SECS) * LATENCY_BINS_PER_DECADE)) + 2
+LATENCY_BIN_EDGES = LATENCY_MIN_SECS * 10 ** (np.arange(LATENCY_NUM_BINS - 1) / LATENCY_BINS_PER_DECADE)
+# Columns of the latency stats array
+LATENCY_STATS = ["count", "total", "max"]
+
+
+def get_metric_names(sphero_config):
+    """
+    Every latency metric the library records, in the row order of the shared histogram arrays.
+    """
+    names = ["rgb_arrival", "depth_arrival", "audio_arrival"]
+    for metric in ["arrival", "action_round_trip", "action_ack", "ble_write_ack", "command_queue_wait",
+                   "recovery"]:
+        names += [f"sphero{sphero_elt}_{metric}" for sphero_elt in range(sphero_config["SIMULTANEOUS_SPHEROS"])]
+    names += ["get_states_copy", "state_machine_event"]
+    return names
+
+
+def latency_bin(seconds):
+    """
+    Histogram bin of a latency, without numpy so producers' hot paths stay cheap.
+    """
+    if seconds < LATENCY_MIN_SECS:
+        return 0
+    return min(int(math.log10(seconds / LATENCY_MIN_SECS) * LATENCY_BINS_PER_DECADE) + 1, LATENCY_NUM_BINS - 1)
+
+
+def record_latency(shared_resources, metric, seconds):
+    """
+    Add a latency sample to a shared histogram. No locks: each metric should have a single writing
+    process (get_states_copy can lose the odd sample if several processes query at once).
+    """
+    if shared_resources.read_only:
+        return
+    row = shared_resources.metric_rows[metric]
+    shared_resources.resources["np_array_latency_histograms"][row, latency_bin(seconds)] += 1
+    stats = shared_resources.resources["np_array_latency_stats"][row]
+    stats[0] += 1
+    stats[1] += seconds
+    if seconds > stats[2]:
+        stats[2] = seconds
+
+
+def summarize_latencies(histograms, stats, metric_names):
+    """
+    Count, mean, max and approximate percentiles (upper edge of the percentile's bin) of every metric.
+    """
+    summary = dict()
+    upper_edges = np.append(LATENCY_BIN_EDGES, np.inf)
+    for row, name in enumerate(metric_names):
+        count, total, maximum = stats[row]
+        metric = {"count": int(count), "mean": float(total / count) if count else None,
+                  "max": float(maximum) if count else None,
+                  "histogram": histograms[row].copy(), "bin_edges": LATENCY_BIN_EDGES}
+        cumulative = np.cumsum(histograms[row])
+        for percentile in [50, 90, 99]:
+            metric[f"p{percentile}"] = float(min(
+                upper_edges[np.searchsorted(cumulative, cumulative[-1] * percentile / 100)], maximum)) if count else None
+        summary[name] = metric
+    return summary
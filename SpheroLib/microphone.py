@@ -1,4 +1,6 @@
-import numpy as np
+from SpheroLib.metrics import record_latency
+from SpheroLib.log_ring import log_message
+import threading
 
 
 def run_microphone(shared_resources):
@@ -6,29 +8,42 @@ def run_microphone(shared_resources):
     import sounddevice as sd
     import time as pytime
 
-    shared_resources.resources["logging_queue"].put("[run microphone] Running the audio stream")
+    log_message(shared_resources, "microphone", "[run microphone] Running the audio stream")
 
     # Assign the nice microphone to be default input
     sd.default.device = ['Q9-1', 'default']
     devices = sd.query_devices()
-    shared_resources.resources["logging_queue"].put(f"audio devices: {devices}")
+    log_message(shared_resources, "microphone", f"audio devices: {devices}")
     i = 0
 
     def audio_callback(outdata, frames, time, status, special=None):
         timestamp = pytime.time()
 
-        shared_resources.resources["np_array_audio"][:] = np.insert(
-            outdata, 0,
-            shared_resources.resources["np_array_audio"][:],
-            axis=0)[shared_resources.sphero_config["AUDIO_BYTES_PER_SAMPLE"]:]
-        shared_resources.resources["np_array_timestamps"][2] = timestamp
-        shared_resources.resources["np_array_packet_counters"][2] += 1
-
+        # Ring buffer of blocksize blocks, so the realtime callback only ever copies its own block
+        pointer = shared_resources.resources["audio_ring_buffer_pointer"].value
+        shared_resources.begin_write(2)
+        try:
+            shared_resources.resources["np_array_audio_blocks"][pointer] = outdata
+            shared_resources.resources["np_array_audio_timestamps"][pointer] = timestamp
+            shared_resources.resources["audio_ring_buffer_pointer"].value = \
+                (pointer + 1) % shared_resources.resources["np_array_audio_blocks"].shape[0]
+            shared_resources.resources["np_array_timestamps"][2] = timestamp
+            shared_resources.resources["np_array_packet_counters"][2] += 1
+        finally:
+            shared_resources.end_write(2)
+        # PortAudio's stream clock gives how long ago the block's first sample hit the adc
+        record_latency(shared_resources, "audio_arrival",
+                       time.currentTime - time.inputBufferAdcTime + pytime.time() - timestamp)
+
+    # The stream runs on PortAudio's thread. Park this one until the stream stops, so a dead
+    # stream ends the process instead of silently going stale.
+    stream_finished = threading.Event()
     with sd.InputStream(channels=1,
                         callback=audio_callback,
+                        finished_callback=stream_finished.set,
                         blocksize=shared_resources.sphero_config["AUDIO_BYTES_PER_SAMPLE"],
                         samplerate=shared_resources.sphero_config["AUDIO_BYTES_PER_SECOND"],
                         latency=.01):
-        while True:
-            pytime.sleep(.001)
+        stream_finished.wait()
+    log_message(shared_resources, "microphone", "[run microphone] Audio stream finished")
 
@@ -0,0 +1,54 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+
+class Scheduler:
+    """
+    One thread that runs callbacks at deadlines, in place of a threading.Timer thread per delay.
+    Pending calls live in a heap ordered by deadline, and the thread sleeps on a condition until the
+    earliest one is due or an earlier one is added.
+    """
+
+    def __init__(self, name="scheduler"):
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay, fn, *args):
+        """
+        Run fn(*args) on the scheduler thread in delay seconds. Returns a handle for cancel().
+        """
+        # [deadline, tie breaker, fn, args]. The tie breaker keeps the heap from ever comparing fns.
+        call = [time.monotonic() + delay, next(self.counter), fn, args]
+        with self.condition:
+            heapq.heappush(self.heap, call)
+            if self.heap[0] is call:
+                self.condition.notify()
+        return call
+
+    @staticmethod
+    def cancel(call):
+        """
+        Stop a pending call from running. Does nothing if it already ran or call is None.
+        """
+        if call is not None:
+            call[2] = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, fn, args = heapq.heappop(self.heap)
+            if fn is None:
+                continue
+            try:
+                fn(*args)
+            except Exception:
+                # Like a Timer thread, report it and carry on with everyone else's calls
+                traceback.print_exc()
@@ -1,65 +1,172 @@
+from SpheroLib.state_machine import post_event, DISCONNECTED, WAITING_FOR_SENSORS, RUNNING, SPHERO_WARMING_UP, \
+    SPHERO_READY, SPHERO_LOST
+from SpheroLib.log_ring import log_message
+import numpy as np
+import json
+import os
 import time
 
 
+def record_sphero_sensor_rate(shared_resources, start_time, start_counters):
+    """
+    Save the mean sphero packet rate since start_time, so the next library start can size
+    SPHERO_LENGTH_STATE from it (see config.py). The rate is clamped to SPHERO_SENSOR_RATE_BOUNDS
+    of the target, so one bad measurement can't size the next run's buffers.
+    """
+    sphero_config = shared_resources.sphero_config
+    counters = shared_resources.resources["np_array_packet_counters"][3:]
+    rate = float((counters - start_counters).mean() / (time.time() - start_time))
+    rate = float(np.clip(rate, *np.multiply(sphero_config["SPHERO_SENSOR_RATE_BOUNDS"],
+                                            sphero_config["SPHERO_TARGET_SENSOR_RATE"])))
+    os.makedirs(os.path.dirname(sphero_config["SPHERO_SENSOR_RATE_PATH"]), exist_ok=True)
+    with open(sphero_config["SPHERO_SENSOR_RATE_PATH"] + ".tmp", "w") as rate_file:
+        json.dump({"rate": rate, "interval_ms": sphero_config["SPHERO_SENSOR_INTERVAL_MS"],
+                   "variables": sphero_config["SPHERO_OUTPUT_VARIABLES"]}, rate_file)
+    os.replace(sphero_config["SPHERO_SENSOR_RATE_PATH"] + ".tmp", sphero_config["SPHERO_SENSOR_RATE_PATH"])
+    log_message(shared_resources, "sensor_monitor", f"[Sensor Monitor] Measured sphero sensor rate {rate:.2f}hz")
+
+
+def stream_names(sphero_config):
+    """
+    Name of every stream, in np_array_timestamps order.
+    """
+    return ["rgb", "depth", "audio"] + [f"sphero{sphero_elt}" for sphero_elt in
+                                        range(sphero_config["SIMULTANEOUS_SPHEROS"])]
+
+
+def expected_stream_periods(sphero_config):
+    """
+    Seconds between the updates each stream should publish, in np_array_timestamps order.
+    """
+    return np.array([1 / sphero_config["CAMERA_FPS"]] * 2 + [sphero_config["AUDIO_SECS_PER_SAMPLE"]] +
+                    [1 / sphero_config["SPHERO_SENSOR_RATE"]] * sphero_config["SIMULTANEOUS_SPHEROS"])
+
+
+def stream_lost_secs(sphero_config):
+    """
+    Seconds each stream can go quiet before it is lost: STREAM_LOST_PERIODS of its expected
+    periods, and at least STREAM_LOST_MIN_SECS.
+    """
+    return np.maximum(expected_stream_periods(sphero_config) * sphero_config["STREAM_LOST_PERIODS"],
+                      sphero_config["STREAM_LOST_MIN_SECS"])
+
+
+def check_stream_rates(shared_resources, expected_periods, lost_secs):
+    """
+    Flag streams whose measured period is over STREAM_DEGRADED_RATIO times the expected one in
+    np_array_stream_degraded, logging when that changes. Returns which streams are lost, i.e.
+    have been quiet for longer than lost_secs (see stream_lost_secs).
+    """
+    resources = shared_resources.resources
+    sphero_config = shared_resources.sphero_config
+    periods = resources["np_array_stream_rates"][:, 1]
+    degraded = periods > expected_periods * sphero_config["STREAM_DEGRADED_RATIO"]
+    for stream in np.flatnonzero(degraded != resources["np_array_stream_degraded"]):
+        log_message(shared_resources, "sensor_monitor",
+                    f"[Sensor Monitor] {stream_names(sphero_config)[stream]} stream "
+                    f"{'degraded' if degraded[stream] else 'recovered'}: {1 / periods[stream]:.1f}hz, "
+                    f"expected {1 / expected_periods[stream]:.1f}hz")
+    resources["np_array_stream_degraded"][:] = degraded
+    return time.time() - resources["np_array_timestamps"] > lost_secs
+
+
+def check_sphero_health(shared_resources, sphero_num, lost, rate_start):
+    """
+    Mark a running sphero lost if its stream has gone quiet, and a lost one ready again once it has
+    streamed a full state since. Returns rate_start, dropped when a sphero's counter is reset under it.
+    """
+    health = shared_resources.resources["np_array_sphero_health"]
+    stream = 3 + sphero_num
+    if health[sphero_num] == SPHERO_READY:
+        if lost:
+            log_message(shared_resources, "sensor_monitor", "[Sensor Monitor] Lost Sphero {}".format(sphero_num))
+            health[sphero_num] = SPHERO_LOST
+            shared_resources.resources["np_array_packet_counters"][stream] = 0
+            # Free anyone waiting on its action, set_sphero_action sees it is lost
+            shared_resources.notify_action_taken(sphero_num)
+            post_event(shared_resources, "SPHEROLOST")
+            return None
+    elif shared_resources.resources["np_array_packet_counters"][stream] >= \
+            shared_resources.sphero_config["SPHERO_LENGTH_STATE"]:
+        log_message(shared_resources, "sensor_monitor", "[Sensor Monitor] Sphero {} is back".format(sphero_num))
+        health[sphero_num] = SPHERO_READY
+    return rate_start
+
+
 def run_sensor_monitor(shared_resources):
     """
     When Library is starting up/resetting, indicates when all sensors are online.
-    While running, triggers state machine if we haven't gotten sensor data recently.
+    While running, triggers state machine if we haven't gotten camera or audio data recently.
+    A sphero that goes quiet is instead marked lost in np_array_sphero_health and only its own
+    counters are reset. It is ready again once it has re-filled its state, like at start up.
+    How long counts as quiet scales with each stream's expected period, and streams running
+    slow are flagged as degraded well before that (see check_stream_rates).
+
+    Between checks we block on library_state changes rather than polling, so a
+    state change is acted on immediately and an idle library only wakes to check.
     """
     shared_resources.get_numpy_resources()
+    sphero_config = shared_resources.sphero_config
+    expected_periods = expected_stream_periods(sphero_config)
+    lost_secs = stream_lost_secs(sphero_config)
+    # Updates each stream needs before its state is full
+    state_lengths = np.array([sphero_config["CAMERA_LENGTH_STATE"]] * 2 + [sphero_config["AUDIO_LENGTH_STATE"]] +
+                             [sphero_config["SPHERO_LENGTH_STATE"]] * sphero_config["SIMULTANEOUS_SPHEROS"])
+    # Look a few times within the shortest lost threshold
+    check_interval = lost_secs.min() / 4
+    # (time, sphero packet counters) the current sensor rate measurement started at
+    rate_start = None
     while True:
-        time.sleep(.001)
-        if shared_resources.resources["library_state"].value == 0:
+        library_state = shared_resources.resources["library_state"].value
+        if library_state == DISCONNECTED:
             for i in range(3 + shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"]):
                 shared_resources.resources["np_array_timestamps"][i] = 0
                 shared_resources.resources["np_array_packet_counters"][i] = 0
+            shared_resources.resources["np_array_sphero_health"][:] = SPHERO_WARMING_UP
 
-            shared_resources.resources["state_machine_queue"].put("RESETSTATEVARS")
+            rate_start = None
+            post_event(shared_resources, "RESETSTATEVARS")
             reset_state_time = time.time()
             published_waiting = False
-            time.sleep(.5)
+            shared_resources.wait_for_library_state(lambda state: state != DISCONNECTED, timeout=.5)
 
-        if shared_resources.resources["library_state"].value == 1:
+        elif library_state == WAITING_FOR_SENSORS:
 
             if time.time() - reset_state_time > 20 + shared_resources.sphero_config["STATE_LEN_TIME_SECS"] and not published_waiting:
-                shared_resources.resources["logging_queue"].put(
-                    f"We are waiting on sensors: {shared_resources.resources['np_array_packet_counters']}")
+                log_message(shared_resources, "sensor_monitor",
+                            f"We are waiting on sensors: {shared_resources.resources['np_array_packet_counters']}")
                 published_waiting = True
 
-            sensors_connected = True
-            # RGB IS GO
-            if shared_resources.resources["np_array_packet_counters"][0] < \
-                    shared_resources.sphero_config["CAMERA_LENGTH_STATE"]:
-                sensors_connected = False
-            # DEPTH IS GO
-            if shared_resources.resources["np_array_packet_counters"][1] < \
-                    shared_resources.sphero_config["CAMERA_LENGTH_STATE"]:
-                sensors_connected = False
-            # AUDIO IS GO
-            if shared_resources.resources["np_array_packet_counters"][2] < \
-                    shared_resources.sphero_config["AUDIO_LENGTH_STATE"]:
-                sensors_connected = False
+            # A stream is go once it has filled its state and is still streaming
+            ready = (shared_resources.resources["np_array_packet_counters"] >= state_lengths) & \
+                ~check_stream_rates(shared_resources, expected_periods, lost_secs)
             # SPHEROS ARE GO
-            for sphero_elt in range(shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"]):
-                if shared_resources.resources["np_array_packet_counters"][3 + sphero_elt] < \
-                        shared_resources.sphero_config["SPHERO_LENGTH_STATE"]:
-                    sensors_connected = False
+            shared_resources.resources["np_array_sphero_health"][ready[3:]] = SPHERO_READY
             # LETS GO!
-            if sensors_connected:
-                shared_resources.resources["state_machine_queue"].put("ALLSENSORSGO")
-                time.sleep(.5)
-
-        if shared_resources.resources["library_state"].value == 5:
-            for elt, timestamp in enumerate(shared_resources.resources["np_array_timestamps"]):
-                if time.time() - timestamp > 2:
-                    if elt == 0:
-                        shared_resources.resources["state_machine_queue"].put("RGBLOST")
-                    elif elt == 1:
-                        shared_resources.resources["state_machine_queue"].put("DEPTHLOST")
-                    elif elt == 2:
-                        shared_resources.resources["state_machine_queue"].put("AUDIOLOST")
-                    else:
-                        shared_resources.resources["logging_queue"].put(
-                            "[Sensor Monitor] Lost Sphero {}".format(elt - 3))
-                        shared_resources.resources["state_machine_queue"].put("SPHEROLOST")
-            time.sleep(1)
\ No newline at end of file
+            if ready.all():
+                post_event(shared_resources, "ALLSENSORSGO")
+                shared_resources.wait_for_library_state(lambda state: state != WAITING_FOR_SENSORS, timeout=.5)
+            else:
+                # Warm-up takes seconds, checking counters at 10hz is plenty
+                shared_resources.wait_for_library_state(lambda state: state != WAITING_FOR_SENSORS, timeout=.1)
+
+        elif library_state == RUNNING:
+            if shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"] > 0:
+                # Only measure while every sphero is streaming, so a lost one doesn't drag the rate down
+                if rate_start is None:
+                    if (shared_resources.resources["np_array_sphero_health"] == SPHERO_READY).all():
+                        rate_start = (time.time(),
+                                      shared_resources.resources["np_array_packet_counters"][3:].copy())
+                elif time.time() - rate_start[0] > shared_resources.sphero_config["SPHERO_SENSOR_RATE_MEASURE_SECS"]:
+                    record_sphero_sensor_rate(shared_resources, *rate_start)
+                    rate_start = None
+            lost = check_stream_rates(shared_resources, expected_periods, lost_secs)
+            for stream, event in enumerate(["RGBLOST", "DEPTHLOST", "AUDIOLOST"]):
+                if lost[stream]:
+                    post_event(shared_resources, event)
+            for sphero_elt in range(sphero_config["SIMULTANEOUS_SPHEROS"]):
+                rate_start = check_sphero_health(shared_resources, sphero_elt, lost[3 + sphero_elt], rate_start)
+            shared_resources.wait_for_library_state(lambda state: state != RUNNING, timeout=check_interval)
+
+        else:
+            shared_resources.wait_for_library_state(lambda state, old_state=library_state: state != old_state)
@@ -1,30 +1,89 @@
+from SpheroLib.metrics import LATENCY_NUM_BINS, LATENCY_STATS, get_metric_names
+from SpheroLib.command_queue import COMMAND_QUEUE_STATS
+from SpheroLib.state_machine import STATE_TRACE, STATES
+from SpheroLib.log_ring import LOG_ARGS_BYTES, log_sources
+from SpheroLib.sensor_monitor import expected_stream_periods
 import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
 import numpy as np
-import ctypes
+import atexit
+import json
+import os
+import sys
+import time
+
+# Named shared memory segment layout: SHARED_MEMORY_MAGIC, the header length as a little endian uint64,
+# then a json header describing every array, padded to SHARED_MEMORY_HEADER_BYTES. The arrays follow.
+SHARED_MEMORY_MAGIC = b"SPHEROSH"
+SHARED_MEMORY_VERSION = 1
+SHARED_MEMORY_HEADER_BYTES = 1 << 16
+SHARED_MEMORY_ALIGNMENT = 64
+# Never published in the header, which any process on the machine may be able to read
+SHARED_MEMORY_PRIVATE_CONFIG = ["SLACKTOKEN"]
+# Columns of np_array_stream_rates: last publish time, and moving averages of the interval
+# between publishes and of its deviation from that average
+STREAM_RATE_STATS = ["last", "period", "jitter"]
+
+
+def attach_shared_memory(name, track=True):
+    """
+    Open an existing named segment. With track=False the segment is left alone when this process exits;
+    before python 3.13 the resource tracker would otherwise unlink it from under the library.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=track)
+    segment = shared_memory.SharedMemory(name=name)
+    if not track:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Alive, just not ours to signal
+        return True
+    return True
+
+
+class SharedValue:
+    """
+    mp.Value-like handle on a one element shared array, so values can live in the shared memory segment.
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    @property
+    def value(self):
+        return self.array[0].item()
+
+    @value.setter
+    def value(self, value):
+        self.array[0] = value
 
 
 class SharedResources:
     """
     Class for creating all the shared arrays, values, and queues used in library processes.
+
+    The arrays and values live in one named shared memory segment (SHARED_MEMORY_NAME) with a
+    self-describing header, so processes outside the library can attach() to them read-only.
     """
 
     def __init__(self, sphero_config):
         self.sphero_config = sphero_config
+        self.read_only = False
         self.resources = dict()
+        self.array_layout = self.get_array_layout(sphero_config)
+        self.shared_memory = self.create_shared_memory()
+        atexit.register(self.unlink)
 
-        # State of the library
-        lib_state = mp.Value('i')
-        lib_state.value = 0
-        self.resources["library_state"] = lib_state
-
-        # Pointer to which index in the rgb-d buffers we are up to
-        self.resources["rgbd_pointer_lock"] = mp.Lock()
-        rgb_ring_buffer_pointer = mp.Value('i')
-        rgb_ring_buffer_pointer.value = 0
-        self.resources["rgb_ring_buffer_pointer"] = rgb_ring_buffer_pointer
-        depth_ring_buffer_pointer = mp.Value('i')
-        depth_ring_buffer_pointer.value = 0
-        self.resources["depth_ring_buffer_pointer"] = depth_ring_buffer_pointer
+        # Notified whenever the state machine changes library_state
+        self.resources["library_state_condition"] = mp.Condition()
 
         # Queues for passing information
         self.resources["rgb_queue"] = mp.Queue(maxsize=2)
@@ -36,95 +95,362 @@ class SharedResources:
 
         self.resources["state_machine_queue"] = mp.Queue()
         self.resources["battery_queue"] = mp.Queue()
-        self.resources["logging_queue"] = mp.Queue(maxsize=10)
 
-        # Shared Arrays
-        self.resources["mp_array_rgb"] = mp.Array(ctypes.c_uint8,
-                                sphero_config["CAMERA_LENGTH_STATE_FULL"] * \
-                                sphero_config["RGB_HEIGHT_PX"] * \
-                                sphero_config["RGB_WIDTH_PX"] * \
-                                3)
+        if sphero_config["SIMULTANEOUS_SPHEROS"] > 0:
+            # Notified by a sphero process when it has taken its action
+            self.resources["action_conditions"] = [mp.Condition() for _ in
+                                                   range(sphero_config["SIMULTANEOUS_SPHEROS"])]
+
+        # Released by each stream's producer when it publishes a new sample (see end_write)
+        self.resources["update_semaphores"] = [mp.BoundedSemaphore(1) for _ in
+                                               range(3 + sphero_config["SIMULTANEOUS_SPHEROS"])]
+        self.get_numpy_resources()
+        if sphero_config["SIMULTANEOUS_SPHEROS"] > 0:
+            self.resources["np_array_sphero_actions"][:, 2] = 0
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Read-only, zero copy view of a running library's shared resources, from any process.
+        Arrays are the library's live buffers, so read them through read_consistent().
+        Queues and conditions stay private to the library; waits fall back to polling.
+        """
+        self = cls.__new__(cls)
+        self.read_only = True
+        self.resources = dict()
+        self.shared_memory = attach_shared_memory(name, track=False)
+        header = self.read_header(self.shared_memory)
+        self.sphero_config = header["sphero_config"]
+        self.array_layout = header["arrays"]
+        self.get_numpy_resources()
+        return self
 
-        self.resources["mp_array_depth"] = mp.Array(ctypes.c_uint16,
-                                  sphero_config["CAMERA_LENGTH_STATE_FULL"] * \
-                                  sphero_config["DEPTH_HEIGHT_PX"] * \
-                                  sphero_config["DEPTH_WIDTH_PX"])
+    @staticmethod
+    def get_array_layout(sphero_config):
+        """
+        Name, dtype, shape and byte offset of every shared array in the segment.
+        """
+        num_spheros = sphero_config["SIMULTANEOUS_SPHEROS"]
+        specs = [
+            # State of the library
+            ("library_state", "int32", [1]),
+            # Ring of the latest library state transitions, one state_machine.STATE_TRACE row each, and
+            # the number written so far
+            ("state_trace", "float64", [sphero_config["STATE_TRACE_LENGTH"], len(STATE_TRACE)]),
+            ("state_trace_pointer", "int64", [1]),
+            # Seconds spent in each state of state_machine.STATES before the current one, and when
+            # the current one was entered
+            ("state_durations", "float64", [len(STATES)]),
+            ("state_entered", "float64", [1]),
+            # Pointer to which index in the rgb-d buffers we are up to
+            ("rgb_ring_buffer_pointer", "int32", [1]),
+            ("depth_ring_buffer_pointer", "int32", [1]),
+            # Pointer to which block (AUDIO_BYTES_PER_SAMPLE samples) in the audio buffer we are up to
+            ("audio_ring_buffer_pointer", "int32", [1]),
+            ("rgb", "uint8", [sphero_config["CAMERA_LENGTH_STATE_FULL"], sphero_config["RGB_HEIGHT_PX"],
+                              sphero_config["RGB_WIDTH_PX"], 3]),
+            ("depth", "uint16", [sphero_config["CAMERA_LENGTH_STATE_FULL"], sphero_config["DEPTH_HEIGHT_PX"],
+                                 sphero_config["DEPTH_WIDTH_PX"]]),
+            # Capture time of every frame in the rgb-d ring buffers
+            ("rgb_timestamps", "float64", [sphero_config["CAMERA_LENGTH_STATE_FULL"]]),
+            ("depth_timestamps", "float64", [sphero_config["CAMERA_LENGTH_STATE_FULL"]]),
+            ("audio", "float32", [sphero_config["AUDIO_BYTES_PER_STATE"], 1]),
+            ("audio_timestamps", "float64", [sphero_config["AUDIO_LENGTH_STATE"]]),
+        ]
+        if num_spheros > 0:
+            specs += [
+                ("sphero_states", "float32", [num_spheros, sphero_config["SPHERO_LENGTH_STATE"],
+                                              len(sphero_config["SPHERO_OUTPUT_VARIABLES"])]),
+                # Sphero state rings: per sphero write pointer, plus the time and packet number of every row
+                ("sphero_ring_pointers", "int32", [num_spheros]),
+                ("sphero_row_timestamps", "float64", [num_spheros, sphero_config["SPHERO_LENGTH_STATE"]]),
+                ("sphero_row_sequence", "int64", [num_spheros, sphero_config["SPHERO_LENGTH_STATE"]]),
+                ("sphero_actions", "int16", [num_spheros, 3]),
+                ("sphero_sleep", "int8", [num_spheros]),
+                ("sphero_battery", "float32", [num_spheros]),
+                # Depth and throughput of each sphero's BLE command queue
+                ("sphero_command_queue_stats", "int64", [num_spheros, len(COMMAND_QUEUE_STATS)]),
+                # When each sphero's current dropout began, 0 while it is up. Feeds the recovery metric.
+                ("sphero_down_since", "float64", [num_spheros]),
+            ]
+        specs += [
+            # state_machine.SPHERO_WARMING_UP / SPHERO_READY / SPHERO_LOST of each sphero. Allocated, empty,
+            # with no spheros too, so the sensor monitor and get_sphero_health need no special case.
+            ("sphero_health", "int8", [num_spheros]),
+            # Per stream: rgb, depth, audio, sphero0 ... sphero N
+            ("timestamps", "float64", [3 + num_spheros]),
+            # Generation counters
+            ("packet_counters", "int32", [3 + num_spheros]),
+            # Seqlock sequence numbers. Each stream has a single writer that makes its counter
+            # odd while it is mid-update, so writers never wait on readers.
+            ("sequence_counters", "int64", [3 + num_spheros]),
+            # Producer maintained STREAM_RATE_STATS, and whether the sensor monitor finds each stream
+            # slower than expected
+            ("stream_rates", "float64", [3 + num_spheros, len(STREAM_RATE_STATS)]),
+            ("stream_degraded", "int8", [3 + num_spheros]),
+            # Hot path latency histograms, one row per metrics.get_metric_names entry
+            ("latency_histograms", "int64", [len(get_metric_names(sphero_config)), LATENCY_NUM_BINS]),
+            ("latency_stats", "float64", [len(get_metric_names(sphero_config)), len(LATENCY_STATS)]),
+            # Log rings, one row per log_ring.log_sources entry. Each source's writer owns its write counter
+            # and drop count, the logger owns the read counters.
+            ("log_times", "float64", [len(log_sources(sphero_config)), sphero_config["LOG_RING_LENGTH"]]),
+            ("log_codes", "uint16", [len(log_sources(sphero_config)), sphero_config["LOG_RING_LENGTH"]]),
+            ("log_args", f"S{LOG_ARGS_BYTES}", [len(log_sources(sphero_config)), sphero_config["LOG_RING_LENGTH"]]),
+            ("log_write_counters", "int64", [len(log_sources(sphero_config))]),
+            ("log_read_counters", "int64", [len(log_sources(sphero_config))]),
+            ("log_dropped", "int64", [len(log_sources(sphero_config))]),
+        ]
 
-        self.resources["mp_array_audio"] = mp.Array(ctypes.c_float,
-                                                    sphero_config["AUDIO_BYTES_PER_STATE"])
+        layout = dict()
+        offset = SHARED_MEMORY_HEADER_BYTES
+        for name, dtype, shape in specs:
+            layout[name] = {"dtype": dtype, "shape": shape, "offset": offset}
+            offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+            offset += -offset % SHARED_MEMORY_ALIGNMENT
+        return layout
 
-        if sphero_config["SIMULTANEOUS_SPHEROS"] > 0:
-            self.resources["mp_array_sphero_states"] = mp.Array(ctypes.c_float,
-                                                                sphero_config["SIMULTANEOUS_SPHEROS"] * \
-                                                                sphero_config["SPHERO_LENGTH_STATE"] * \
-                                                                len(sphero_config["SPHERO_OUTPUT_VARIABLES"]))
+    def create_shared_memory(self):
+        """
+        Create the named segment and write its header.
+        """
+        name = self.sphero_config.get("SHARED_MEMORY_NAME", "sphero_library")
+        size = max([spec["offset"] + int(np.prod(spec["shape"])) * np.dtype(spec["dtype"]).itemsize
+                    for spec in self.array_layout.values()])
+        try:
+            segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a library that did not shut down cleanly, unless its owner is still running
+            self.check_segment_abandoned(name)
+            stale_segment = attach_shared_memory(name)
+            stale_segment.close()
+            stale_segment.unlink()
+            segment = shared_memory.SharedMemory(name=name, create=True, size=size)
 
-            self.resources["mp_array_sphero_actions"] = mp.Array(ctypes.c_int16,
-                                                                 sphero_config["SIMULTANEOUS_SPHEROS"] * 3)
+        num_spheros = self.sphero_config["SIMULTANEOUS_SPHEROS"]
+        header = json.dumps({
+            "version": SHARED_MEMORY_VERSION,
+            "owner_pid": os.getpid(),
+            "sphero_config": {key: value for key, value in self.sphero_config.items()
+                              if key not in SHARED_MEMORY_PRIVATE_CONFIG},
+            "streams": ["rgb", "depth", "audio"] + [f"sphero{sphero_elt}" for sphero_elt in range(num_spheros)],
+            "ring_pointers": {"rgb": "rgb_ring_buffer_pointer", "depth": "depth_ring_buffer_pointer",
+                              "audio": "audio_ring_buffer_pointer", "spheros": "sphero_ring_pointers"},
+            "generation_counters": "packet_counters",
+            "sequence_counters": "sequence_counters",
+            "arrays": self.array_layout}).encode()
+        assert len(header) + 16 <= SHARED_MEMORY_HEADER_BYTES, "shared memory header is too large"
+        segment.buf[:8] = SHARED_MEMORY_MAGIC
+        segment.buf[8:16] = len(header).to_bytes(8, "little")
+        segment.buf[16:16 + len(header)] = header
+        return segment
 
-            self.resources["mp_array_sphero_sleep"] = mp.Array(ctypes.c_uint8,
-                                                               sphero_config["SIMULTANEOUS_SPHEROS"])
+    @staticmethod
+    def check_segment_abandoned(name):
+        """
+        Raise FileExistsError unless the existing segment name is a sphero library segment whose
+        owner process has exited, so it is safe to unlink.
+        """
+        segment = attach_shared_memory(name, track=False)
+        try:
+            if bytes(segment.buf[:8]) != SHARED_MEMORY_MAGIC:
+                raise FileExistsError(f"{name} exists and is not a sphero library segment")
+            header_length = int.from_bytes(segment.buf[8:16], "little")
+            try:
+                owner_pid = json.loads(bytes(segment.buf[16:16 + header_length])).get("owner_pid")
+            except ValueError:
+                # Its owner died before finishing the header
+                owner_pid = None
+        finally:
+            segment.close()
+        if owner_pid is not None and process_alive(owner_pid):
+            raise FileExistsError(f"{name} is in use by the library in process {owner_pid}, "
+                                  f"give this one another SHARED_MEMORY_NAME")
 
-            self.resources["mp_array_sphero_battery"] = mp.Array(ctypes.c_float,
-                                                                 sphero_config["SIMULTANEOUS_SPHEROS"])
+    @staticmethod
+    def read_header(segment):
+        assert bytes(segment.buf[:8]) == SHARED_MEMORY_MAGIC, f"{segment.name} is not a sphero library segment"
+        header_length = int.from_bytes(segment.buf[8:16], "little")
+        header = json.loads(bytes(segment.buf[16:16 + header_length]))
+        assert header["version"] == SHARED_MEMORY_VERSION, f"unsupported segment version {header['version']}"
+        return header
 
-        self.resources["mp_array_timestamps"] = mp.Array(ctypes.c_double,
-                                                         3 + sphero_config["SIMULTANEOUS_SPHEROS"])
+    def __getstate__(self):
+        # Child processes reattach to the segment by name rather than pickling copies of every array
+        state = self.__dict__.copy()
+        state["shared_memory"] = self.shared_memory.name
+        state["resources"] = {key: value for key, value in self.resources.items()
+                              if not key.startswith("np_array_") and not isinstance(value, SharedValue)}
+        return state
 
-        self.resources["mp_array_packet_counters"] = mp.Array(
-            ctypes.c_int32, 3 + sphero_config["SIMULTANEOUS_SPHEROS"])
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shared_memory = attach_shared_memory(state["shared_memory"], track=not self.read_only)
         self.get_numpy_resources()
 
     def get_numpy_resources(self):
-        np_array_rgb = np.frombuffer(
-            self.resources["mp_array_rgb"].get_obj(), dtype=np.uint8)
-
-        self.resources["np_array_rgb"] = np_array_rgb.reshape([
-            self.sphero_config["CAMERA_LENGTH_STATE_FULL"],
-            self.sphero_config["RGB_HEIGHT_PX"],
-            self.sphero_config["RGB_WIDTH_PX"],
-            3])
-
-        np_array_depth = np.frombuffer(
-            self.resources["mp_array_depth"].get_obj(), dtype=np.uint16)
-        self.resources["np_array_depth"] = np_array_depth.reshape([
-            self.sphero_config["CAMERA_LENGTH_STATE_FULL"],
-            self.sphero_config["DEPTH_HEIGHT_PX"],
-            self.sphero_config["DEPTH_WIDTH_PX"]])
-
-        np_array_audio = np.frombuffer(self.resources["mp_array_audio"].get_obj(),
-                                       dtype=np.float32)
-        self.resources["np_array_audio"] = np_array_audio.reshape(
-            self.sphero_config["AUDIO_BYTES_PER_STATE"], 1)
-
-        if self.sphero_config["SIMULTANEOUS_SPHEROS"] > 0:
-            np_array_sphero_states = np.frombuffer(self.resources["mp_array_sphero_states"].get_obj(),
-                                                   dtype=np.float32)
-            self.resources["np_array_sphero_states"] = np_array_sphero_states.reshape(
-                [self.sphero_config["SIMULTANEOUS_SPHEROS"],
-                 self.sphero_config["SPHERO_LENGTH_STATE"],
-                 len(self.sphero_config["SPHERO_OUTPUT_VARIABLES"])])
-
-            np_array_sphero_actions = np.frombuffer(self.resources["mp_array_sphero_actions"].get_obj(), dtype=np.int16)
-            self.resources["np_array_sphero_actions"] = np_array_sphero_actions.reshape(
-                [self.sphero_config["SIMULTANEOUS_SPHEROS"], 3])
-            self.resources["np_array_sphero_actions"][:, 2] = 0
+        for name, spec in self.array_layout.items():
+            array = np.ndarray(spec["shape"], dtype=spec["dtype"], buffer=self.shared_memory.buf,
+                               offset=spec["offset"])
+            if self.read_only:
+                array.flags.writeable = False
+            self.resources[f"np_array_{name}"] = array
+
+        for name in ["library_state", "rgb_ring_buffer_pointer", "depth_ring_buffer_pointer",
+                     "audio_ring_buffer_pointer"]:
+            self.resources[name] = SharedValue(self.resources[f"np_array_{name}"])
+
+        self.resources["np_array_audio_blocks"] = self.resources["np_array_audio"].reshape(
+            self.sphero_config["AUDIO_LENGTH_STATE"], self.sphero_config["AUDIO_BYTES_PER_SAMPLE"], 1)
+        self.metric_rows = {name: row for row, name in enumerate(get_metric_names(self.sphero_config))}
+        self.log_rows = {name: row for row, name in enumerate(log_sources(self.sphero_config))}
+        self.expected_periods = expected_stream_periods(self.sphero_config)
+
+    def close(self):
+        """
+        Drop this process's view of the segment. The library's owner should also unlink() it.
+        """
+        self.resources = {key: value for key, value in self.resources.items()
+                          if not key.startswith("np_array_") and not isinstance(value, SharedValue)}
+        self.shared_memory.close()
+
+    def unlink(self):
+        """
+        Remove the segment's name once the library is done with it. Attached processes keep their views.
+        """
+        try:
+            self.shared_memory.unlink()
+        except FileNotFoundError:
+            pass
+
+    def begin_write(self, stream):
+        """
+        Mark a stream (index into np_array_timestamps) as mid-update. Only the stream's producer calls this.
+        """
+        self.resources["np_array_sequence_counters"][stream] += 1
+
+    def end_write(self, stream):
+        """
+        Mark a stream's update as complete, publishing it to readers and waking anyone in wait_for_update.
+        The stream's np_array_timestamps entry should hold the update's time by now.
+
+        Never waits, whatever state the readers are in: the wakeup is a release of the stream's bounded
+        semaphore, which is a single sem_post and no lock. If the semaphore is already up, a wakeup is
+        pending anyway and this one is dropped.
+        """
+        self.update_stream_rate(stream)
+        self.resources["np_array_sequence_counters"][stream] += 1
+        self.wake_update_waiter(stream)
+
+    def wake_update_waiter(self, stream):
+        try:
+            self.resources["update_semaphores"][stream].release()
+        except ValueError:
+            # Already released and not yet taken
+            pass
+
+    def update_stream_rate(self, stream):
+        """
+        Fold the interval since the stream's last update into its period and jitter averages. The period
+        starts out at the expected one, and an interval of more than STREAM_LOST_PERIODS expected periods
+        is an outage rather than a rate, so it only restarts timing. Measuring against the expected period
+        rather than the measured one keeps a single early interval from pinning the average.
+        """
+        rates = self.resources["np_array_stream_rates"][stream]
+        timestamp = self.resources["np_array_timestamps"][stream]
+        interval = timestamp - rates[0]
+        last = rates[0]
+        rates[0] = timestamp
+        if not last or interval <= 0:
+            return
+        if not rates[1]:
+            rates[1] = self.expected_periods[stream]
+        if interval < self.expected_periods[stream] * self.sphero_config["STREAM_LOST_PERIODS"]:
+            alpha = self.sphero_config["STREAM_RATE_EWMA_ALPHA"]
+            rates[2] += alpha * (abs(interval - rates[1]) - rates[2])
+            rates[1] += alpha * (interval - rates[1])
+
+    def wait_for_update(self, stream, since, timeout=None):
+        """
+        Block until the stream's packet counter differs from since, or timeout seconds pass.
+        Returns the new packet counter, or None on timeout.
+        """
+        packet_counters = self.resources["np_array_packet_counters"]
+        if self.read_only:
+            return int(packet_counters[stream]) if self.poll(lambda: packet_counters[stream] != since, timeout) \
+                else None
+        # The semaphore only holds one wakeup, so each waiter that gets one passes it on to the next.
+        # A wakeup left over from before this call is taken first, the counter check below covers it.
+        semaphore = self.resources["update_semaphores"][stream]
+        semaphore.acquire(False)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while packet_counters[stream] == since:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            semaphore.acquire(timeout=remaining)
+        self.wake_update_waiter(stream)
+        return int(packet_counters[stream])
+
+    def read_consistent(self, read_fn, streams=None):
+        """
+        Seqlock read. Calls read_fn() until no writer touched the given streams (default all) during the
+        call, so the result is one consistent snapshot across them. read_fn must only copy, never block.
+        """
+        sequence_counters = self.resources["np_array_sequence_counters"]
+        if streams is None:
+            streams = slice(None)
+        while True:
+            sequence_before = sequence_counters[streams].copy()
+            if np.any(sequence_before & 1):
+                # A writer is mid-update, give it the cpu
+                time.sleep(0)
+                continue
+            result = read_fn()
+            if np.array_equal(sequence_before, sequence_counters[streams]):
+                return result
+
+    def set_library_state(self, state):
+        """
+        Change library_state and wake everyone waiting on it. Only the state machine calls this.
+        """
+        with self.resources["library_state_condition"]:
+            self.resources["library_state"].value = state
+            self.resources["library_state_condition"].notify_all()
 
-            self.resources["np_array_sphero_sleep"] = np.frombuffer(
-                self.resources["mp_array_sphero_sleep"].get_obj(), dtype=np.int8)
+    def wait_for_library_state(self, predicate, timeout=None):
+        """
+        Block until predicate(library_state) holds or timeout seconds pass. Returns the predicate's value.
+        """
+        if self.read_only:
+            return self.poll(lambda: predicate(self.resources["library_state"].value), timeout)
+        with self.resources["library_state_condition"]:
+            return self.resources["library_state_condition"].wait_for(
+                lambda: predicate(self.resources["library_state"].value), timeout)
 
-            np_array_sphero_battery = np.frombuffer(self.resources["mp_array_sphero_battery"].get_obj(),
-                                                    dtype=np.float32)
-            self.resources["np_array_sphero_battery"] = np_array_sphero_battery.reshape(
-                self.sphero_config["SIMULTANEOUS_SPHEROS"])
+    @staticmethod
+    def poll(predicate, timeout=None, interval=.01):
+        """
+        Stand-in for Condition.wait_for in attached processes, which cannot share the library's conditions.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not predicate():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(interval)
+        return True
 
-        np_array_packet_counters = np.frombuffer(
-            self.resources["mp_array_packet_counters"].get_obj(),
-            dtype=np.int32)
-        self.resources["np_array_packet_counters"] = np_array_packet_counters.reshape(
-            [3 + self.sphero_config["SIMULTANEOUS_SPHEROS"]])
+    def notify_action_taken(self, sphero_num):
+        """
+        Clear a sphero's action flag once its action has been run, waking set_sphero_action.
+        """
+        with self.resources["action_conditions"][sphero_num]:
+            self.resources["np_array_sphero_actions"][sphero_num][2] = 0
+            self.resources["action_conditions"][sphero_num].notify_all()
 
-        np_array_timestamps = np.frombuffer(self.resources["mp_array_timestamps"].get_obj(),
-                                            dtype=np.float64)
-        self.resources["np_array_timestamps"] = np_array_timestamps.reshape(
-            [3 + self.sphero_config["SIMULTANEOUS_SPHEROS"]])
+    def wait_for_action_taken(self, sphero_num, timeout=None):
+        """
+        Block until a sphero has no pending action or timeout seconds pass. Returns whether it is free.
+        """
+        with self.resources["action_conditions"][sphero_num]:
+            return self.resources["action_conditions"][sphero_num].wait_for(
+                lambda: self.resources["np_array_sphero_actions"][sphero_num][2] == 0, timeout)
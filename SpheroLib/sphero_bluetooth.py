@@ -1,8 +1,14 @@
-import struct
 from SpheroLib.bluetooth_constants import *
+from SpheroLib.metrics import record_latency
+from SpheroLib.log_ring import log_message, log_event, LOG_SENSOR_PACKET_INCOMPLETE, LOG_SENSOR_NANS, \
+	LOG_WRITE_FAILED
+from SpheroLib.sphero_protocol import PacketDecoder, SensorResponseDecoder, CommandEncoder, Frame, command_name, \
+	sensor_stream_layout
+from SpheroLib.scheduler import Scheduler
+from SpheroLib.command_queue import CommandQueue, PRIORITY_DRIVE, PRIORITY_YAW, PRIORITY_CONFIG, PRIORITY_LEDS
+from collections import deque, Counter
 import time
 import threading
-import numpy as np
 import os
 import multiprocessing as mp
 import gatt
@@ -13,59 +19,172 @@ GATT bluetooth library https://github.com/getsenic/gatt-python
 Alternative Python Lib https://github.com/EnotYoyo/pysphero
 """
 
+# Resolved characteristics of every sphero this process has connected to, by mac address. A reconnect
+# uses these instead of waiting on service discovery again.
+CHARACTERISTIC_CACHE = dict()
 
-def run_sphero(shared_resources, sphero_num, kill_switch):
+
+def run_sphero_worker(shared_resources, sphero_nums, kill_switches):
+	"""
+	Drive a shard of the spheros from one process. They share one gatt DeviceManager (so one
+	GLib loop on hci0) and one scheduler thread. A sphero that loses its connection restarts
+	itself without disturbing the others.
+	"""
 	shared_resources.get_numpy_resources()
 	manager = gatt.DeviceManager(adapter_name="hci0")
-	mac_address = shared_resources.sphero_config["SPHEROMACS"][sphero_num]
-	device = SpheroDevice(shared_resources, mac_address, manager, sphero_num, kill_switch)
-	device.connect()
+	scheduler = Scheduler()
+	devices = []
+	for sphero_num, kill_switch in zip(sphero_nums, kill_switches):
+		mac_address = shared_resources.sphero_config["SPHEROMACS"][sphero_num]
+		devices.append(SpheroDevice(shared_resources, mac_address, manager, sphero_num, kill_switch, scheduler))
+		devices[-1].connect()
 	manager.run()
 
 
 class SpheroDevice(gatt.Device):
-	def __init__(self, shared_resources, mac_address, manager, sphero_num, kill_switch):
+	def __init__(self, shared_resources, mac_address, manager, sphero_num, kill_switch, scheduler):
 		super().__init__(mac_address=mac_address, manager=manager)
+		self.scheduler = scheduler
 		self.kill_switch = kill_switch
 		self.sphero_num = sphero_num
 		self.shared_resources = shared_resources
+		self.encoder = CommandEncoder()
+		self.sensor_mask, self.extended_sensor_mask, response_variables = sensor_stream_layout(
+			shared_resources.sphero_config["SPHERO_OUTPUT_VARIABLES"])
+		self.sensor_decoder = SensorResponseDecoder(shared_resources.sphero_config["SPHERO_OUTPUT_VARIABLES"],
+													response_variables)
+		# Action in progress: [heading, speed, start time], its retry call, and the latest sensor yaw
+		self.action = None
+		self.action_retry = None
+		self.action_lock = threading.RLock()
+		self.heartbeat_call = None
+		self.heartbeat_stage = None
+		# Held while a heartbeat stage is scheduled or run. Stages are run from the scheduler thread and
+		# advanced from the GLib one, this keeps the two from both running a stage.
+		self.heartbeat_lock = threading.RLock()
+		self.battery_call = None
+		# Failed reconnects since we were last running, for the backoff
+		self.restart_attempts = 0
+		# Lives across reconnects so its stats cover the whole run, reset_connection_state only clears its buffer
+		self.decoder = PacketDecoder()
+		self.reset_connection_state()
+		self.yaw = 0.
+		self.yaw_index = shared_resources.sphero_config["SPHERO_OUTPUT_VARIABLES"].index("yaw") \
+			if "yaw" in shared_resources.sphero_config["SPHERO_OUTPUT_VARIABLES"] else None
+		assert self.yaw_index is not None or shared_resources.sphero_config["SPHERO_ACTION_RESET_YAW"], \
+			"Making headings relative without resetting yaw needs yaw in SPHERO_OUTPUT_VARIABLES"
+		self.message_handlers = dict()
+		self.message_counts = Counter()
+		self.message_count_log_time = time.time()
+		self.register_default_handlers()
+		self.capture_file = None
+		if shared_resources.sphero_config["SPHERO_NOTIFICATION_CAPTURE"]:
+			log_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../Logs/"))
+			os.makedirs(log_dir, exist_ok=True)
+			self.capture_file = open(os.path.join(log_dir, f"sphero{sphero_num}_notifications.txt"), "a")
+		self.log(f"Init sphero device {os.getpid()}")
+		self.start_heartbeat("start")
+
+	def reset_connection_state(self):
+		"""
+		State of one connection to the sphero, set up on init and again on every restart.
+		An action that was in progress is run again once we are back up.
+		"""
 		self.status_dict = {"connected": True, "resolved": False, "notifications_enabled": True,
 							"state": "init", "voltage": None, "last_battery_time": None}
-		self.bluetooth_resources = {"command_queue": [], "prev_update_value": None, "active_commands": mp.Value("i"),
-									"characs_dict": {}, "seqNumber": 0}
-		self.log(f"Init sphero device {os.getpid()}")
-		threading.Timer(1, self.heartbeat, args=("start",)).start()
+		self.bluetooth_resources = {"prev_update_value": None, "characs_dict": {}, "write_times": deque()}
+		self.command_queue = CommandQueue(
+			self.write_value, self.shared_resources.sphero_config["BLE_MAX_OUTSTANDING_WRITES"],
+			record_wait=lambda seconds: record_latency(
+				self.shared_resources, f"sphero{self.sphero_num}_command_queue_wait", seconds),
+			stats=self.shared_resources.resources["np_array_sphero_command_queue_stats"][self.sphero_num])
+		self.notification_time = time.time()
+		self.decoder.reset()
+		actions = self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num]
+		with self.action_lock:
+			self.scheduler.cancel(self.action_retry)
+			self.action = None
+			if actions[2] in [2, 4]:
+				actions[2] = 1
+
+	def start_heartbeat(self, tag, delay=1):
+		"""
+		Check on stage tag after delay. The delay is a deadline: the event the stage waits
+		for calls advance_heartbeat to move on as soon as it happens.
+		"""
+		with self.heartbeat_lock:
+			self.heartbeat_stage = tag
+			self.heartbeat_call = self.scheduler.call_later(delay, self.heartbeat, tag)
+
+	def advance_heartbeat(self, tag):
+		"""
+		Run stage tag now if it is the one waiting, rather than at its deadline.
+		"""
+		with self.heartbeat_lock:
+			if self.heartbeat_stage == tag:
+				self.scheduler.cancel(self.heartbeat_call)
+				self.start_heartbeat(tag, delay=0)
+
+	def poll_battery(self):
+		"""
+		Ask for the battery voltage every SPHERO_BATTERY_POLL_SECS while running.
+		"""
+		self.get_battery_update()
+		self.battery_call = self.scheduler.call_later(
+			self.shared_resources.sphero_config["SPHERO_BATTERY_POLL_SECS"], self.poll_battery)
+
+	def cancel_scheduled_calls(self):
+		"""
+		Stop this connection's heartbeat, battery polls and action retries.
+		"""
+		with self.heartbeat_lock:
+			self.heartbeat_stage = None
+			for call in [self.heartbeat_call, self.battery_call, self.action_retry]:
+				self.scheduler.cancel(call)
 
 	def log(self, message):
-		message = f"[Sphero {self.sphero_num}] {message}"
-		self.shared_resources.resources["logging_queue"].put(message)
+		"""
+		Log under this sphero's source. Never blocks, so it is safe on the bluetooth callbacks.
+		"""
+		log_message(self.shared_resources, f"sphero{self.sphero_num}", message)
 
 	def heartbeat(self, tag):
+		"""
+		Run stage tag, unless it is no longer the one waiting: it already ran, or was cancelled.
+		"""
+		with self.heartbeat_lock:
+			if self.heartbeat_stage != tag:
+				return
+			self.heartbeat_stage = None
+			self.run_heartbeat_stage(tag)
+
+	def run_heartbeat_stage(self, tag):
 		if tag == "start":
-			if self.status_dict["connected"] and self.status_dict["resolved"] and \
-					self.status_dict["notifications_enabled"]:
+			if self.status_dict["connected"] and self.status_dict["notifications_enabled"] and \
+					(self.status_dict["resolved"] or self.mac_address in CHARACTERISTIC_CACHE):
 				self.log("[Heartbeat] We are connected correctly")
-				self.init_characs()
+				if not self.init_characs():
+					return
 				self.log("[Heartbeat] Init Characs")
 				self.set_up_sphero()
 				self.log("[Heartbeat] Set Up Sphero")
 				self.wake_sphero()
 				self.log("[Heartbeat] Sent Wake Signal")
-				threading.Timer(1, self.heartbeat, args=("wake",)).start()
+				self.start_heartbeat("wake")
 			else:
 				self.log(f"[Heartbeat] Connection failure {self.status_dict}")
 				self.signal_restart()
 		elif tag == "wake":
 			if self.status_dict["state"] == "awake":
 				self.configure_sphero()
-				threading.Timer(1, self.heartbeat, args=("voltage",)).start()
+				self.start_heartbeat("voltage")
 			else:
 				self.log(f"[Heartbeat] Sphero did not wake up")
 				self.signal_restart()
 		elif tag == "voltage":
 			if self.status_dict["voltage"] is not None:
 				self.configure_sensor_stream()
-				threading.Timer(1, self.heartbeat, args=("sensor",)).start()
+				self.start_heartbeat("sensor")
 			else:
 				self.log(f"[Heartbeat] Sphero failed to get voltage")
 				self.signal_restart()
@@ -73,7 +192,16 @@ class SpheroDevice(gatt.Device):
 			if time.time() - self.shared_resources.resources["np_array_timestamps"][3 + self.sphero_num] < .5:
 				self.log(f"[Heartbeat] Entering Running State")
 				self.status_dict["state"] = "running"
-				threading.Timer(1, self.heartbeat, args=("beat",)).start()
+				self.restart_attempts = 0
+				down_since = self.shared_resources.resources["np_array_sphero_down_since"]
+				if down_since[self.sphero_num] > 0:
+					record_latency(self.shared_resources, f"sphero{self.sphero_num}_recovery",
+								   time.time() - down_since[self.sphero_num])
+					down_since[self.sphero_num] = 0
+				self.start_heartbeat("beat")
+				if self.shared_resources.sphero_config["SPHERO_BATTERY_POLL_SECS"] is not None:
+					self.battery_call = self.scheduler.call_later(
+						self.shared_resources.sphero_config["SPHERO_BATTERY_POLL_SECS"], self.poll_battery)
 			else:
 				self.log(f"[Heartbeat] Sphero failed to start sensor stream")
 				self.signal_restart()
@@ -81,29 +209,63 @@ class SpheroDevice(gatt.Device):
 			if time.time() - self.shared_resources.resources["np_array_timestamps"][3 + self.sphero_num] > .5:
 				self.log(f"[Heartbeat] Sphero lost sensor stream")
 				self.signal_restart()
+				return
 			if self.status_dict["voltage"] < self.shared_resources.sphero_config["SPHERO_LOW_VOLTAGE"]:
 				self.log(f"[Heartbeat] Sphero battery low: {self.status_dict['voltage']}")
 				self.signal_battery_low()
 			else:
-				if time.time() - self.status_dict["last_battery_time"] > 10:
-					# self.get_battery_update()
-					pass #TODO TURN BATTERY BACK ON
-				threading.Timer(1, self.heartbeat, args=("beat",)).start()
+				if time.time() - self.message_count_log_time > \
+						self.shared_resources.sphero_config["SPHERO_MESSAGE_COUNT_LOG_SECS"]:
+					self.log_message_counts()
+				self.start_heartbeat("beat")
 
 	def signal_restart(self):
+		"""
+		Drop the connection and start over, reusing this device object. Other spheros in
+		the process carry on. The wait starts at SPHERO_RESTART_MIN_SECS and doubles with
+		each attempt that fails to get back to running, up to SPHERO_RESTART_MAX_SECS. The
+		kill switch stays raised while we are down so the manager can see it.
+		"""
+		if self.status_dict["state"] in ["restarting", "stopped"]:
+			return
+		self.status_dict["state"] = "restarting"
 		self.kill_switch.value = 1
+		down_since = self.shared_resources.resources["np_array_sphero_down_since"]
+		if down_since[self.sphero_num] == 0:
+			down_since[self.sphero_num] = time.time()
+		self.cancel_scheduled_calls()
 		self.disconnect()
-		while True:
-			time.sleep(1)
+		delay = min(self.shared_resources.sphero_config["SPHERO_RESTART_MIN_SECS"] * 2 ** self.restart_attempts,
+					self.shared_resources.sphero_config["SPHERO_RESTART_MAX_SECS"])
+		self.restart_attempts += 1
+		self.log(f"[Restart] Reconnecting in {delay:.2f}s")
+		self.scheduler.call_later(delay, self.reconnect)
+
+	def reconnect(self):
+		self.log("[Restart] Reconnecting")
+		self.scheduler.cancel(self.heartbeat_call)
+		self.reset_connection_state()
+		self.kill_switch.value = 0
+		# Wait on the start stage before connecting, so connect_succeeded finds it to advance
+		self.start_heartbeat("start")
+		self.connect()
 
 	def signal_battery_low(self):
+		"""
+		Disconnect and stay down until the library is restarted.
+		"""
+		if self.status_dict["state"] == "stopped":
+			return
+		self.status_dict["state"] = "stopped"
 		self.kill_switch.value = 2
+		self.cancel_scheduled_calls()
 		self.disconnect()
-		while True:
-			time.sleep(1)
 
 	def connect_succeeded(self):
 		super().connect_succeeded()
+		# A sphero we have resolved before can skip service discovery and use its cached characteristics
+		if self.mac_address in CHARACTERISTIC_CACHE:
+			self.advance_heartbeat("start")
 
 	def connect_failed(self, error):
 		self.status_dict["connected"] = False
@@ -113,6 +275,7 @@ class SpheroDevice(gatt.Device):
 	def services_resolved(self):
 		self.status_dict["resolved"] = True
 		super().services_resolved()
+		self.advance_heartbeat("start")
 
 	def characteristic_enable_notifications_succeeded(self, characteristic):
 		self.status_dict["notifications_enabled"] = True
@@ -134,6 +297,9 @@ class SpheroDevice(gatt.Device):
 		if value == self.bluetooth_resources["prev_update_value"]:
 			return
 		self.bluetooth_resources["prev_update_value"] = value
+		self.notification_time = time.time()
+		if self.capture_file is not None:
+			self.capture_file.write(bytes(value).hex() + "\n")
 		self.on_value_change(value)
 
 	def characteristic_write_value_succeeded(self, characteristic):
@@ -141,56 +307,61 @@ class SpheroDevice(gatt.Device):
 		If there are more things on the queue to do, call them.
 		Otherwise indicate that there are no active outgoing messages
 		"""
-		self.bluetooth_resources["active_commands"].value -= 1
-		if self.bluetooth_resources["command_queue"]:
-			(characteristic_uuid, command) = self.bluetooth_resources["command_queue"].pop(0)
-			self.write_value(characteristic_uuid, command)
+		if self.bluetooth_resources["write_times"]:
+			record_latency(self.shared_resources, f"sphero{self.sphero_num}_ble_write_ack",
+						   time.time() - self.bluetooth_resources["write_times"].popleft())
+		self.command_queue.write_done()
 
 	def write_value(self, charac, value):
 		"""
-		Write a value to sphero characteristic
+		Write a value to sphero characteristic. Only the command queue calls this.
 		"""
-		self.bluetooth_resources["active_commands"].value += 1
+		self.bluetooth_resources["write_times"].append(time.time())
 		self.bluetooth_resources["characs_dict"][charac].write_value(value)
 
-	def enqueue_command(self, q_command):
+	def enqueue_command(self, q_command, priority=PRIORITY_CONFIG, coalesce_key=None):
 		"""
-		If there are already 1+ commands on the queue, simply add. When
-		the next message comes back, it will call the next one.
-		If there are 0 and no active message, write command ourselves.
+		Hand a (characteristic, value) write to the command queue. It is written
+		once a write slot is free and no higher priority command is waiting.
+		A waiting command with the same coalesce_key is replaced rather than queued behind.
 		"""
-		if self.bluetooth_resources["active_commands"].value == 0:
-			self.write_value(q_command[0], q_command[1])
-		else:
-			self.bluetooth_resources["command_queue"].append(q_command)
+		self.command_queue.put(q_command[0], q_command[1], priority, coalesce_key)
 
 	def characteristic_write_value_failed(self, characteristic, error):
 		"""
 		Called by the bluetooth library.
 		"""
-		self.bluetooth_resources["active_commands"].value -= 1
-		error = str(error)
-		self.log(f"[Write Val Failed] {error}")
+		if self.bluetooth_resources["write_times"]:
+			self.bluetooth_resources["write_times"].popleft()
+		self.command_queue.write_done()
+		log_event(self.shared_resources, f"sphero{self.sphero_num}", LOG_WRITE_FAILED, error)
 
 	def init_characs(self):
 		"""
 		Setup some services, called once on startup.
 		Returns bool indicating success
 		"""
-		for service in self.services:
-			for characteristic in service.characteristics:
-				self.bluetooth_resources["characs_dict"][characteristic.uuid] = characteristic
+		if self.status_dict["resolved"] or self.mac_address not in CHARACTERISTIC_CACHE:
+			for service in self.services:
+				for characteristic in service.characteristics:
+					self.bluetooth_resources["characs_dict"][characteristic.uuid] = characteristic
+			CHARACTERISTIC_CACHE[self.mac_address] = dict(self.bluetooth_resources["characs_dict"])
+		else:
+			self.bluetooth_resources["characs_dict"].update(CHARACTERISTIC_CACHE[self.mac_address])
 
 		# Fail if we are missing the API characteristic
 		if APIV2_CHARACTERISTIC not in self.bluetooth_resources["characs_dict"].keys():
 			self.log("[Init Characs] The API characteristic is not found. You probably hit that button.")
+			CHARACTERISTIC_CACHE.pop(self.mac_address, None)
 			self.signal_restart()
+			return False
 
 		# Enable notifications for characteristic callbacks,
 		# for characteristics I know allow notification
 		for uuid, characteristic in self.bluetooth_resources["characs_dict"].items():
 			if uuid in NOTIFICATION_CHARACTERISTICS:
 				characteristic.enable_notifications()
+		return True
 
 	def set_up_sphero(self):
 		"""
@@ -199,7 +370,7 @@ class SpheroDevice(gatt.Device):
 		necessary.
 		Finally, try to wake the sphero.
 		"""
-		self.write_value(ANTIDOS_CHARACTERISTIC, useTheForce)
+		self.enqueue_command((ANTIDOS_CHARACTERISTIC, useTheForce))
 		self.reset_incoming_buffer()
 
 	def on_wakeup(self):
@@ -208,6 +379,7 @@ class SpheroDevice(gatt.Device):
 		"""
 		self.log("[On Wakeup] Sphero is awake")
 		self.status_dict["state"] = "awake"
+		self.advance_heartbeat("wake")
 
 	def configure_sphero(self):
 		"""
@@ -233,67 +405,76 @@ class SpheroDevice(gatt.Device):
 
 	def run_action(self):
 		"""
-		Called once to get things started, then called again each time
-		a write value to the sphero succeeds.
+		Called on every sensor update while running. Starts a new action if one is available.
 
-		Run function to get and issue roll commands
-		Every second, run battery voltage and charging function
+		Actions are driven by acks rather than polling. The action flag goes 1 (new) -> 2 (reset
+		yaw sent) -> on_reset_yaw -> 4 (roll sent) -> on_roll -> 5 (done), and notify_action_taken
+		clears it. A step that is not acked within SPHERO_ACTION_RETRY_SECS is resent from the scheduler.
+
+		With SPHERO_ACTION_RESET_YAW off, the relative heading is turned into an absolute one from
+		the latest sensor yaw instead, skipping the reset yaw round trip.
 		"""
-		if self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] == 1:
+		actions = self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num]
+		with self.action_lock:
+			if actions[2] != 1:
+				# No new action is available
+				return
 			# New action is available.
-			desired_heading = int(self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][0])
-			desired_speed = int(self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][1])
-			# These are special characters and you cannot use them :)
-			if desired_heading in [141, 171, 216]:
-				desired_heading += 1
-			if desired_speed in [141, 171, 216]:
-				desired_speed += 1
-
-			# With reset Yaw
-			self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] = 2
-			self.reset_yaw()
-			threading.Timer(.01, self.check_yaw_reset, args=(desired_speed, desired_heading)).start()
-
-			# Without reset yaw
-			# self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] = 4
-			# self.roll(desired_speed, desired_heading)
-			# threading.Timer(.01, self.check_action, args=(desired_speed, desired_heading)).start()
-		else:
-			# No new action is available
-			return
+			desired_heading = int(actions[0])
+			desired_speed = int(actions[1])
+			self.action = [desired_heading, desired_speed, time.time()]
+			if self.shared_resources.sphero_config["SPHERO_ACTION_RESET_YAW"]:
+				actions[2] = 2
+				self.reset_yaw()
+			else:
+				# Sensor yaw is counterclockwise positive, headings are clockwise
+				self.action[0] = int(round(desired_heading - self.yaw)) % 360
+				actions[2] = 4
+				self.roll(desired_speed, self.action[0])
+			self.schedule_action_retry()
 
-	def check_yaw_reset(self, desired_speed, desired_heading):
-		if self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] not in [3, 2]:
-			return
+	def schedule_action_retry(self):
+		self.scheduler.cancel(self.action_retry)
+		self.action_retry = self.scheduler.call_later(
+			self.shared_resources.sphero_config["SPHERO_ACTION_RETRY_SECS"], self.retry_action)
 
-		start = time.time()
-		while time.time() - start < .2:
-			if self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] == 3:
-				self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] = 4
-				self.roll(desired_speed, desired_heading)
-				threading.Timer(.01, self.check_action, args=(desired_speed, desired_heading)).start()
+	def retry_action(self):
+		"""
+		Called by the scheduler when the current action step was not acked in time. Resend it.
+		"""
+		actions = self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num]
+		with self.action_lock:
+			if self.action is None:
 				return
-		self.reset_yaw()
-		threading.Timer(.01, self.check_yaw_reset, args=(desired_speed, desired_heading)).start()
-
-	def check_action(self, desired_speed, desired_heading):
-		if self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] not in [4, 5]:
-			return
-		start = time.time()
-		while time.time() - start < .2:
-			if self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] == 5:
-				self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] = 0
+			if actions[2] == 2:
+				self.reset_yaw()
+			elif actions[2] == 4:
+				self.roll(self.action[1], self.action[0])
+			else:
 				return
-		self.roll(desired_speed, desired_heading)
-		threading.Timer(.01, self.check_action, args=(desired_speed, desired_heading)).start()
+			self.schedule_action_retry()
 
 	def on_reset_yaw(self):
-		if self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] == 2:
-			self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] = 3
+		actions = self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num]
+		with self.action_lock:
+			if actions[2] != 2 or self.action is None:
+				return
+			actions[2] = 4
+			# A retried reset yaw still waiting would be written after the roll and re-zero the heading mid drive
+			self.command_queue.discard("yaw")
+			self.roll(self.action[1], self.action[0])
+			self.schedule_action_retry()
 
 	def on_roll(self):
-		if self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] == 4:
-			self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num][2] = 5
+		actions = self.shared_resources.resources["np_array_sphero_actions"][self.sphero_num]
+		with self.action_lock:
+			if actions[2] != 4 or self.action is None:
+				return
+			actions[2] = 5
+			self.scheduler.cancel(self.action_retry)
+			record_latency(self.shared_resources, f"sphero{self.sphero_num}_action_ack", time.time() - self.action[2])
+			self.action = None
+			self.shared_resources.notify_action_taken(self.sphero_num)
 
 	def roll(self, speed, heading):
 		"""
@@ -310,7 +491,7 @@ class SpheroDevice(gatt.Device):
 			commandId=DrivingCommandIds["driveWithHeading"],
 			targetId=0x012,
 			data=[speed, (heading >> 8) & 0xff, heading & 0xff, 0]))
-		self.enqueue_command(q_command)
+		self.enqueue_command(q_command, PRIORITY_DRIVE, coalesce_key="drive")
 
 	def reset_yaw(self):
 		"""
@@ -320,7 +501,7 @@ class SpheroDevice(gatt.Device):
 			deviceId=DeviceId["driving"],
 			commandId=DrivingCommandIds["resetYaw"],
 			targetId=0x012))
-		self.enqueue_command(q_command)
+		self.enqueue_command(q_command, PRIORITY_YAW, coalesce_key="yaw")
 
 	def color_matrix(self, rgb):
 		"""
@@ -332,7 +513,7 @@ class SpheroDevice(gatt.Device):
 			commandId=UserIOCommandIds["matrixColor"],
 			targetId=0x012,
 			data=rgb))
-		self.enqueue_command(q_command)
+		self.enqueue_command(q_command, PRIORITY_LEDS)
 
 	def set_front_back_leds(self, front, back):
 		"""
@@ -342,7 +523,7 @@ class SpheroDevice(gatt.Device):
 			deviceId=DeviceId["userIO"],
 			commandId=UserIOCommandIds["allLEDs"],
 			data=[0x3f, *front, *back]))
-		self.enqueue_command(q_command)
+		self.enqueue_command(q_command, PRIORITY_LEDS)
 
 	def unset_stabilization(self):
 		q_command = (APIV2_CHARACTERISTIC, self.create_command(
@@ -367,8 +548,7 @@ class SpheroDevice(gatt.Device):
 		Called with we realize a packet we are reading is fubar.
 		Reset the buffer so we can try again.
 		"""
-		self.packet = []
-		self.escaped = False
+		self.decoder.reset()
 
 	def get_battery_update(self):
 		"""
@@ -389,18 +569,13 @@ class SpheroDevice(gatt.Device):
 		Create and pass a message to sphero telling her
 		we want sensor values passed to us as they update.
 
-		There are 2 magic numbers here I just got from inspection of the
-		JS library.
+		Only the sensors in SPHERO_OUTPUT_VARIABLES are streamed, every
+		SPHERO_SENSOR_INTERVAL_MS. Gyro values need the extended mask.
 		"""
-		mask = [SensorMaskValues["accelerometer"],
-				SensorMaskValues["orientation"],
-				SensorMaskValues["locator"],
-				SensorMaskValues["gyro"]]
-		interval = 100
-		aol_num = 516216
-		gyro_num = 58720256
+		interval = self.shared_resources.sphero_config["SPHERO_SENSOR_INTERVAL_MS"]
+		mask, extended_mask = self.sensor_mask, self.extended_sensor_mask
 
-		# This command activates the accelerometer, orientation, locator
+		# This command sets the interval and activates the accelerometer, orientation, locator
 		q_command = (APIV2_CHARACTERISTIC, self.create_command(
 			deviceId=DeviceId["sensor"],
 			commandId=SensorCommandIds["sensorMask"],
@@ -408,10 +583,7 @@ class SpheroDevice(gatt.Device):
 			data=[(interval >> 8) & 0xff,
 				  interval & 0xff,
 				  0,
-				  (aol_num >> 24) & 0xff,
-				  (aol_num >> 16) & 0xff,
-				  (aol_num >> 8) & 0xff,
-				  aol_num & 0xff]))
+				  *mask.to_bytes(4, "big")]))
 		self.enqueue_command(q_command)
 
 		# This command activates the gyroscope
@@ -419,10 +591,7 @@ class SpheroDevice(gatt.Device):
 			deviceId=DeviceId["sensor"],
 			commandId=SensorCommandIds["sensorMaskExtended"],
 			targetId=0x012,
-			data=[(gyro_num >> 24) & 0xff,
-				  (gyro_num >> 16) & 0xff,
-				  (gyro_num >> 8) & 0xff,
-				  gyro_num & 0xff]))
+			data=extended_mask.to_bytes(4, "big")))
 		self.enqueue_command(q_command)
 
 	def create_command(self, deviceId, commandId, targetId=None, data=None):
@@ -436,40 +605,10 @@ class SpheroDevice(gatt.Device):
 
 		The flags byte indicates which fields are populated.
 
-		The checksum is the ~sum(message[1:-2]) | 0xff.
-		"""
-		self.bluetooth_resources["seqNumber"] = (self.bluetooth_resources["seqNumber"] + 1) % 255
-		running_sum = 0
-		command = []
-		command.append(APIConstants["startOfPacket"])
-		if targetId is None:
-			cmdflg = Flags["requestsResponse"] | \
-					 Flags["resetsInactivityTimeout"] | 0
-			command.append(cmdflg)
-			running_sum += cmdflg
-		else:
-			cmdflg = Flags["requestsResponse"] | \
-					 Flags["resetsInactivityTimeout"] | targetId
-			command.append(cmdflg)
-			running_sum += cmdflg
-			command.append(targetId)
-			running_sum += targetId
-
-		command.append(deviceId)
-		running_sum += deviceId
-		command.append(commandId)
-		running_sum += commandId
-		command.append(self.bluetooth_resources["seqNumber"])
-		running_sum += self.bluetooth_resources["seqNumber"]
-
-		if data is not None:
-			for datum in data:
-				command.append(datum)
-				running_sum += datum
-		checksum = (~running_sum) & 0xff
-		command.append(checksum)
-		command.append(APIConstants["endOfPacket"])
-		return command
+		The checksum is the ~sum(message[1:-2]) & 0xff, taken before
+		start, end and escape bytes in the message are escaped.
+		"""
+		return self.encoder.encode(deviceId, commandId, targetId, data or b"")
 
 	def on_value_change(self, value):
 		"""
@@ -479,194 +618,109 @@ class SpheroDevice(gatt.Device):
 		must be kept. When a complete fragment is recovered 
 		(with correct checksum), call decode() to interpret it.
 
-		Be on the lookout for "escape characters". My understanding
-		is that if a data-byte is 171 (escape byte), the following byte
-		will be a reserved byte represented as ordinary data. *Or* this
-		next byte with escape mask to get the actual byte. This masked
-		byte is the one the checksum is calculated for.
+		Be on the lookout for "escape characters". If a data-byte is
+		a reserved byte (start, end or escape), it is sent as the escape
+		byte 171 followed by the byte with the escape mask cleared.
+		The checksum is calculated on the unmasked bytes.
 
-		I'm not entirely sure what happens if the number 171 is needed
-		as a regular data-byte, but as of right now checksums are always
-		passing and my "no escaped char..." message is not coming through.
-		Will take another look if it does happen.
+		Reassembly, unescaping and checksums are done a whole
+		notification at a time by sphero_protocol.PacketDecoder, which
+		keeps the partial packet between notifications. Dropped packets
+		are counted in self.decoder.stats.
 
 		Sorry for the long docstring, this took almost a week to work out
 		and it would be a shame to loose this info.
 		"""
-		for val in value:
-			if val == APIConstants["startOfPacket"]:
-				self.reset_incoming_buffer()
-				self.packet.append(val)
-
-			elif val == APIConstants["endOfPacket"]:
-				if len(self.packet) < 6:
-					self.log("[on value change] packet too small")
-					continue
-
-				self.packet.append(val)
-
-				total = sum(self.packet[1:-2])
-				if (~total & 0xff) != self.packet[-2]:
-					# self.log (self.packet)
-					# self.log ("Bad checksum : {}".format(
-					#     (~total & 0xff)))
-					continue
-
-				self.decode(self.packet)
-
-			elif val == APIConstants["escape"]:
-				self.escaped = True
-
-			elif val == APIConstants["escapedEscape"]:
-				if self.escaped:
-					val = val | APIConstants["escapeMask"]
-					self.escaped = False
-				self.packet.append(val)
-
-			elif val == APIConstants["escapedStartOfPacket"]:
-				if self.escaped:
-					val = val | APIConstants["escapeMask"]
-					self.escaped = False
-				self.packet.append(val)
-			elif val == APIConstants["escapedEndOfPacket"]:
-				if self.escaped:
-					val = val | APIConstants["escapeMask"]
-					self.escaped = False
-				self.packet.append(val)
-			else:
-				if self.escaped:
-					self.log("no escaped char ....{}".format(val))
-				else:
-					self.packet.append(val)
+		for packet in self.decoder.feed(value):
+			self.decode(packet)
 
 	def decode(self, packet):
 		"""
-		Break raw message up into a dictionary with relevant fields.
+		Wrap raw message in a Frame, which reads the header fields in place.
 		Pass message on to read_command to pass to a message handler
 		"""
-		command = dict()
-		command["packet"] = packet.copy()
-		command["startOfPacket"] = packet.pop(0)
-		command["flags"] = self.decode_flags(packet.pop(0))
-
-		if command["flags"]["hasTargetId"]:
-			command["targetId"] = packet.pop(0)
-
-		if command["flags"]["hasSourceId"]:
-			command["sourceId"] = packet.pop(0)
-
-		command["deviceId"] = packet.pop(0)
-		command["commandId"] = packet.pop(0)
-		command["seqNumber"] = packet.pop(0)
-
-		command["data"] = []
-		for i in range(len(packet) - 2):
-			command["data"].append(packet.pop(0))
-
-		command["checksum"] = packet.pop(0)
-		command["endOfPacket"] = packet.pop(0)
-		self.read_command(command)
-
-	def decode_flags(self, flags):
-		"""
-		Determine appropriate message flags from the flag byte
-		"""
-		isResponse = flags & Flags["isResponse"]
-		requestsResponse = flags & Flags["requestsResponse"]
-		requestOnlyErrorResponse = flags & Flags["requestsOnlyErrorResponse"]
-		resetsInactivityTimeout = flags & Flags["resetsInactivityTimeout"]
-		hasTargetId = flags & Flags["commandHasTargetId"]
-		hasSourceId = flags & Flags["commandHasSourceId"]
-
-		return {"isResponse": isResponse,
-				"requestsResponse": requestsResponse,
-				"requestOnlyErrorResponse": requestOnlyErrorResponse,
-				"resetsInactivityTimeout": resetsInactivityTimeout,
-				"hasTargetId": hasTargetId,
-				"hasSourceId": hasSourceId}
+		self.read_command(Frame(packet))
+
+	def register_default_handlers(self):
+		"""
+		Handlers for every message we expect from the sphero.
+		Messages we only acknowledge are logged.
+		"""
+		self.register_handler(DeviceId["powerInfo"], PowerCommandIds["charging"], self.on_charging_state)
+		self.register_handler(DeviceId["powerInfo"], PowerCommandIds["batteryVoltage"], self.on_battery_voltage)
+		self.register_handler(DeviceId["powerInfo"], PowerCommandIds["wake"], lambda command: self.on_wakeup())
+		self.register_handler(DeviceId["sensor"], SensorCommandIds["sensorResponse"], self.on_sensor_response)
+		self.register_handler(DeviceId["driving"], DrivingCommandIds["driveWithHeading"], lambda command: self.on_roll())
+		self.register_handler(DeviceId["driving"], DrivingCommandIds["resetYaw"], lambda command: self.on_reset_yaw())
+		self.register_handler(DeviceId["driving"], DrivingCommandIds["stabilization"], lambda command: None)
+		for device_id, command_id, message in [
+				(DeviceId["powerInfo"], PowerCommandIds["willSleepAsync"], "Sphero willSleepAsync do to inactivity"),
+				(DeviceId["powerInfo"], PowerCommandIds["sleepAsync"], "Sphero sleepAsync"),
+				(DeviceId["powerInfo"], PowerCommandIds["unknownWake"], "Sphero Unknown Wake"),
+				(DeviceId["powerInfo"], PowerCommandIds["sleep"], "Sphero sleep"),
+				(DeviceId["sensor"], SensorCommandIds["collisionDetectedAsync"], "Collision Detected"),
+				(DeviceId["sensor"], SensorCommandIds["compassNotify"], "Compass Notified"),
+				(DeviceId["sensor"], SensorCommandIds["resetLocator"], "Locator reset"),
+				(DeviceId["sensor"], SensorCommandIds["sensorMask"], "SensorMask Set"),
+				(DeviceId["sensor"], SensorCommandIds["sensorMaskExtended"], "SensorMask Extended Set"),
+				(DeviceId["userIO"], UserIOCommandIds["matrixColor"], "Matrix Color Set"),
+				(DeviceId["userIO"], UserIOCommandIds["allLEDs"], "Front+Rear Leds set")]:
+			self.register_handler(device_id, command_id,
+								  lambda command, message=message: self.log(f"[read command] {message}"))
+
+	def register_handler(self, device_id, command_id, handler):
+		"""
+		Call handler(frame) for every message with this deviceId and commandId,
+		replacing the current handler. Use for collision events, custom telemetry, etc.
+		"""
+		self.message_handlers[(device_id, command_id)] = handler
 
 	def read_command(self, command):
 		"""
 		Determine appropriate handler for message and call it.
 		"""
-		# Power commands
-		if command["deviceId"] == DeviceId["powerInfo"]:
-			if command["commandId"] == PowerCommandIds["charging"]:
-				if len(command["data"]) <= 1:
-					pass
-				elif command["data"][1] == BatteryState["charging"]:
-					pass
-				elif command["data"][1] == BatteryState["notCharging"]:
-					pass
-				elif command["data"][1] == BatteryState["charged"]:
-					pass
-				else:
-					self.log("Unknown Battery State")
-
-			elif command["commandId"] == PowerCommandIds["batteryVoltage"]:
-				volts = int.from_bytes(command["data"], "big") / 100
-				self.status_dict["voltage"] = volts
-				self.status_dict["last_battery_time"] = time.time()
-				self.shared_resources.resources["np_array_sphero_battery"][self.sphero_num] = self.status_dict[
-					"voltage"]
-			elif command["commandId"] == PowerCommandIds["willSleepAsync"]:
-				self.log("[read command] Sphero willSleepAsync do to inactivity")
-			elif command["commandId"] == PowerCommandIds["sleepAsync"]:
-				self.log("[read command] Sphero sleepAsync")
-			elif command["commandId"] == PowerCommandIds["wake"]:
-				self.on_wakeup()
-			elif command["commandId"] == PowerCommandIds["unknownWake"]:
-				self.log("[read command] Sphero Unknown Wake")
-			elif command["commandId"] == PowerCommandIds["sleep"]:
-				self.log("[read command] Sphero sleep")
-			else:
-				self.log("unknown event a, {}".format(command))
-
-		# Sensor commands
-		elif command["deviceId"] == DeviceId["sensor"]:
-			if command["commandId"] == SensorCommandIds["collisionDetectedAsync"]:
-				self.log("[read command] Collision Detected")
-			elif command["commandId"] == SensorCommandIds["sensorResponse"]:
-				self.handle_sensor_update(command)
-				# Trigger running actions off of the sensor stream
-				if self.status_dict["state"] == "running":
-					self.run_action()
-			elif command["commandId"] == SensorCommandIds["compassNotify"]:
-				self.log("[read command] Compass Notified")
-			elif command["commandId"] == SensorCommandIds["resetLocator"]:
-				self.log("[read command] Locator reset")
-			elif command["commandId"] == SensorCommandIds["sensorMask"]:
-				self.log("[read command] SensorMask Set")
-			elif command["commandId"] == SensorCommandIds["sensorMaskExtended"]:
-				self.log("[read command] SensorMask Extended Set")
-			else:
-				self.log("unknown event b")
-
-		# Driving commands
-		elif command["deviceId"] == DeviceId["driving"]:
-			if command["commandId"] == DrivingCommandIds["driveWithHeading"]:
-				self.on_roll()
-			elif command["commandId"] == DrivingCommandIds["resetYaw"]:
-				self.on_reset_yaw()
-			elif command["commandId"] == DrivingCommandIds["stabilization"]:
-				pass
-			else:
-				self.log("unknown event c")
-
-		# IO (LED) commands
-		elif command["deviceId"] == DeviceId["userIO"]:
-			if command["commandId"] == UserIOCommandIds["matrixColor"]:
-				self.log("[read command] Matrix Color Set")
-			elif command["commandId"] == UserIOCommandIds["allLEDs"]:
-				self.log("[read command] Front+Rear Leds set")
-			else:
-				self.log("unknown event d")
+		key = (command.deviceId, command.commandId)
+		self.message_counts[key] += 1
+		handler = self.message_handlers.get(key)
+		if handler is None:
+			self.log(f"[read command] unknown event {command_name(*key)}, {command}")
 		else:
-			self.log("unknown event e")
+			handler(command)
+
+	def log_message_counts(self):
+		"""
+		Log how many of each message type we have received, busiest first, and how many packets
+		the decoder has dropped.
+		"""
+		self.message_count_log_time = time.time()
+		counts = ", ".join(f"{command_name(*key)}={count}" for key, count in self.message_counts.most_common())
+		self.log(f"[Message counts] {counts}")
+		self.log(f"[Message counts] Dropped packets: bad_checksum={self.decoder.stats['bad_checksum']}, "
+				 f"too_small={self.decoder.stats['too_small']} of {sum(self.decoder.stats.values())}")
+
+	def on_charging_state(self, command):
+		if len(command.data) <= 1:
+			pass
+		elif command.data[1] not in BatteryState.values():
+			self.log("Unknown Battery State")
+
+	def on_battery_voltage(self, command):
+		volts = int.from_bytes(command.data, "big") / 100
+		self.status_dict["voltage"] = volts
+		self.status_dict["last_battery_time"] = time.time()
+		self.shared_resources.resources["np_array_sphero_battery"][self.sphero_num] = self.status_dict["voltage"]
+		self.advance_heartbeat("voltage")
+
+	def on_sensor_response(self, command):
+		self.handle_sensor_update(command)
+		self.advance_heartbeat("sensor")
+		# Trigger running actions off of the sensor stream
+		if self.status_dict["state"] == "running":
+			self.run_action()
 
 	def handle_sensor_update(self, command):
 		"""
-		Read sensor data, converting to float and update sensor dict.
+		Read sensor data, converting to floats in SPHERO_OUTPUT_VARIABLES order.
 
 		Also reset control yaw to the current sensor yaw- this allows 
 		roll to take in relative roll yaw angle commands, even though
@@ -676,78 +730,37 @@ class SpheroDevice(gatt.Device):
 		all the sensor data, as only has components. To deal with this,
 		make sure length of data is long enough to contain all sensors.
 
-		When packet is all read and done, pickle and 
-		fire it off to the server.
+		The row is written straight into this sphero's slot of the
+		shared ring buffer.
 		"""
-		if len(command["data"]) != 13 * 4:
-			self.log("[Handle sensor update] Sensor data packet incomplete")
+		if len(command.data) != self.sensor_decoder.size:
+			log_event(self.shared_resources, f"sphero{self.sphero_num}", LOG_SENSOR_PACKET_INCOMPLETE,
+					  len(command.data))
 			return
-		offset = 0
-		data = command["data"]
-		num_bytes = 4
-		self.sensor_vals = dict()
-		self.sensor_vals["pitch"] = \
-			self.convert_binary_float(data, offset, num_bytes)
-		offset += num_bytes
-		self.sensor_vals["roll"] = \
-			self.convert_binary_float(data, offset, num_bytes)
-		offset += num_bytes
-		self.sensor_vals["yaw"] = \
-			self.convert_binary_float(data, offset, num_bytes)
-		offset += num_bytes
-		self.sensor_vals["ax"] = \
-			self.convert_binary_float(data, offset, num_bytes)
-		offset += num_bytes
-		self.sensor_vals["ay"] = \
-			self.convert_binary_float(data, offset, num_bytes)
-		offset += num_bytes
-		self.sensor_vals["az"] = \
-			self.convert_binary_float(data, offset, num_bytes)
-		offset += num_bytes
-		self.sensor_vals["positionX"] = \
-			self.convert_binary_float(data, offset, num_bytes) * 100.0
-		offset += num_bytes
-		self.sensor_vals["positionY"] = \
-			self.convert_binary_float(data, offset, num_bytes) * 100.0
-		offset += num_bytes
-		self.sensor_vals["velocityX"] = \
-			self.convert_binary_float(data, offset, num_bytes) * 100.0
-		offset += num_bytes
-		self.sensor_vals["velocityY"] = \
-			self.convert_binary_float(data, offset, num_bytes) * 100.0
-		offset += num_bytes
-		self.sensor_vals["wx"] = \
-			self.convert_binary_float(data, offset, num_bytes)
-		offset += num_bytes
-		self.sensor_vals["wy"] = \
-			self.convert_binary_float(data, offset, num_bytes)
-		offset += num_bytes
-		self.sensor_vals["wz"] = \
-			self.convert_binary_float(data, offset, num_bytes)
-		offset += num_bytes
-
-		for key, value in self.sensor_vals.items():
-			if np.isnan(value):
-				self.log("[handle_sensor_update] WE HAVE NANS")
-				self.signal_restart()
-		sphero_state = np.array(
-			[self.sensor_vals[var] for var in self.shared_resources.sphero_config["SPHERO_OUTPUT_VARIABLES"]])
-
-		self.shared_resources.resources["np_array_timestamps"][3 + self.sphero_num] = time.time()
-		self.shared_resources.resources["np_array_packet_counters"][3 + self.sphero_num] += 1
-		self.shared_resources.resources["np_array_sphero_states"][self.sphero_num] = np.insert(
-			self.shared_resources.resources["np_array_sphero_states"][self.sphero_num],
-			0, sphero_state, axis=0)[:-1]
-
-	@staticmethod
-	def convert_binary_float(data, offset, num_bytes):
-		"""
-		Quick conversion from (up to) 4 (big endian) bytes to a 16 bit float
-		"""
-		array = data[offset:offset + num_bytes]
-		byte_array = bytearray(array)
-		val = struct.unpack('>f', byte_array)[0]
-		return val
+		sphero_state = self.sensor_decoder.decode(command.data)
+		if sphero_state is None:
+			log_event(self.shared_resources, f"sphero{self.sphero_num}", LOG_SENSOR_NANS)
+			self.signal_restart()
+			return
+		if self.yaw_index is not None:
+			self.yaw = sphero_state[self.yaw_index]
+
+		timestamp = time.time()
+		resources = self.shared_resources.resources
+		pointer = resources["np_array_sphero_ring_pointers"][self.sphero_num]
+		self.shared_resources.begin_write(3 + self.sphero_num)
+		try:
+			resources["np_array_timestamps"][3 + self.sphero_num] = timestamp
+			resources["np_array_packet_counters"][3 + self.sphero_num] += 1
+			resources["np_array_sphero_states"][self.sphero_num, pointer] = sphero_state
+			resources["np_array_sphero_row_timestamps"][self.sphero_num, pointer] = timestamp
+			resources["np_array_sphero_row_sequence"][self.sphero_num, pointer] = \
+				resources["np_array_packet_counters"][3 + self.sphero_num]
+			resources["np_array_sphero_ring_pointers"][self.sphero_num] = \
+				(pointer + 1) % resources["np_array_sphero_states"].shape[1]
+		finally:
+			self.shared_resources.end_write(3 + self.sphero_num)
+		record_latency(self.shared_resources, f"sphero{self.sphero_num}_arrival", time.time() - self.notification_time)
 
 
 if __name__ == "__main__":
@@ -756,4 +769,4 @@ if __name__ == "__main__":
 
 	shared_resources = SharedResources(sphero_config)
 	kill_switch = mp.Value('i')
-	run_sphero(shared_resources, 0, kill_switch)
+	run_sphero_worker(shared_resources, [0], [kill_switch])
@@ -1,10 +1,13 @@
 from SpheroLib.sphero_manager import SpheroManager
 from SpheroLib.logger import run_logger
-from SpheroLib.state_machine import run_state_machine
+from SpheroLib.state_machine import run_state_machine, RUNNING, SPHERO_READY, STATES, STATE_NAMES, EVENTS
 from SpheroLib.shared_resources import SharedResources
-from SpheroLib.sensor_monitor import run_sensor_monitor
+from SpheroLib.sensor_monitor import run_sensor_monitor, stream_names, expected_stream_periods
 from SpheroLib.camera import run_camera
 from SpheroLib.microphone import run_microphone
+from SpheroLib.metrics import get_metric_names, record_latency, summarize_latencies
+from SpheroLib.command_queue import COMMAND_QUEUE_STATS
+from SpheroLib.log_ring import log_message
 import signal
 import subprocess
 import os
@@ -12,6 +15,9 @@ import multiprocessing as mp
 import numpy as np
 import time
 
+# Sensor modalities in get_sphero_states, in np_array_timestamps order
+MODALITIES = ("rgb", "depth", "audio", "spheros")
+
 
 class SpheroLibrary:
     def __init__(self, sphero_config):
@@ -20,6 +26,16 @@ class SpheroLibrary:
         self.eliminate_old_pids()
         self.run_processes()
 
+    @classmethod
+    def attach(cls, name="sphero_library"):
+        """
+		Read-only handle on a library already running in another process (its SHARED_MEMORY_NAME),
+		for trainers, recorders or visualizers. Supports the state queries, not actions.
+		"""
+        library = cls.__new__(cls)
+        library.shared_resources = SharedResources.attach(name)
+        return library
+
     def signal_handler(self, sig, frame):
         mypid = os.getpid()
         subprocess.call(["kill", "{}".format(mypid)])
@@ -37,48 +53,289 @@ class SpheroLibrary:
         self.procs.append(mp.Process(target=SpheroManager, args=(self.shared_resources, )))
         [proc.start() for proc in self.procs]
 
-    def get_sphero_states(self, sphero_num=None):
+    def get_sphero_states(self, sphero_num=None, out=None, modalities=None, history=None):
         """
 		User command to get the state from the server. Makes a request of
 		a handling process- if the request goes through, will return the state.
 
+		modalities is an optional subset of MODALITIES to return, and history an optional
+		number of newest entries per modality (camera frames, audio blocks of
+		AUDIO_SECS_PER_SAMPLE, sphero rows). Cheap polls such as
+		modalities=["spheros"], history=1 skip copying and waiting on everything else.
+
+		out is an optional dict of caller-owned buffers from allocate_state_buffers(),
+		made with the same modalities and history. When given, the state is written into
+		it instead of freshly allocated arrays, and the returned state/timestamps are those
+		same buffers.
+
 		Returns: [state, timestamps] where
-			state is dict with fields: "rgb", "depth", "spheros", "audio"
+			state is dict with fields: "rgb", "depth", "spheros", "audio", "sphero_timestamps"
+			(rgb, depth and audio oldest first, spheros newest first, sphero_timestamps
+			the capture time of each sphero row)
 			timestamps is np array with time of sensor measurements 
 				(rgb, depth, audio, sphero0 ... sphero N)
 		
 		Otherwise returns False.
 		"""
-        while self.shared_resources.resources["library_state"].value != 5:
-            time.sleep(.001)
-
-        with self.shared_resources.resources["rgbd_pointer_lock"]:
-            rgb_pointer = self.shared_resources.resources["rgb_ring_buffer_pointer"].value
-            rgb_state = np.flip(np.concatenate(
-                [self.shared_resources.resources["np_array_rgb"][rgb_pointer:],
-                 self.shared_resources.resources["np_array_rgb"][:rgb_pointer]])
-                [::-self.shared_resources.sphero_config["CAMERA_OUTPUT_SKIP"]].copy(), axis=0)
-            depth_pointer = self.shared_resources.resources["depth_ring_buffer_pointer"].value
-            depth_state = np.flip(np.concatenate(
-                [self.shared_resources.resources["np_array_depth"][depth_pointer:],
-                 self.shared_resources.resources["np_array_depth"][:depth_pointer]])
-                [::-self.shared_resources.sphero_config["CAMERA_OUTPUT_SKIP"]].copy(), axis=0)
-
-        state = {
-            "rgb": rgb_state,
-            "depth": depth_state,
-            "audio": self.shared_resources.resources["np_array_audio"].copy()}
-        if self.shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"] > 0:
-            state["spheros"] = self.shared_resources.resources["np_array_sphero_states"].copy()
-        timestamps = self.shared_resources.resources["np_array_timestamps"].copy()
+        self.shared_resources.wait_for_library_state(lambda state: state == RUNNING)
+
+        modalities = self.select_modalities(modalities)
+        if out is None:
+            out = self.allocate_state_buffers(modalities, history)
+        resources = self.shared_resources.resources
+        sphero_config = self.shared_resources.sphero_config
+
+        def snapshot():
+            # Only gathers the frames we return, so the window a writer can tear is as short as possible
+            if "rgb" in modalities:
+                rgb_indices = self.ring_buffer_indices(resources["rgb_ring_buffer_pointer"].value,
+                                                       resources["np_array_rgb"].shape[0],
+                                                       sphero_config["CAMERA_OUTPUT_SKIP"])
+                # mode="wrap" lets numpy write straight into out rather than through a temporary
+                np.take(resources["np_array_rgb"], rgb_indices[len(rgb_indices) - len(out["rgb"]):], axis=0,
+                        out=out["rgb"], mode="wrap")
+            if "depth" in modalities:
+                depth_indices = self.ring_buffer_indices(resources["depth_ring_buffer_pointer"].value,
+                                                         resources["np_array_depth"].shape[0],
+                                                         sphero_config["CAMERA_OUTPUT_SKIP"])
+                np.take(resources["np_array_depth"], depth_indices[len(depth_indices) - len(out["depth"]):], axis=0,
+                        out=out["depth"], mode="wrap")
+            if "audio" in modalities:
+                audio_indices = self.ring_buffer_indices(resources["audio_ring_buffer_pointer"].value,
+                                                         resources["np_array_audio_blocks"].shape[0], 1)
+                audio_out = out["audio"].reshape((-1,) + resources["np_array_audio_blocks"].shape[1:])
+                np.take(resources["np_array_audio_blocks"], audio_indices[len(audio_indices) - len(audio_out):],
+                        axis=0, out=audio_out, mode="wrap")
+            if "spheros" in modalities:
+                for sphero_elt, pointer in enumerate(resources["np_array_sphero_ring_pointers"]):
+                    # Newest row first
+                    sphero_indices = self.ring_buffer_indices(
+                        pointer, resources["np_array_sphero_states"].shape[1], 1)[::-1][:out["spheros"].shape[1]]
+                    np.take(resources["np_array_sphero_states"][sphero_elt], sphero_indices, axis=0,
+                            out=out["spheros"][sphero_elt], mode="wrap")
+                    np.take(resources["np_array_sphero_row_timestamps"][sphero_elt], sphero_indices,
+                            out=out["sphero_timestamps"][sphero_elt], mode="wrap")
+            np.copyto(out["timestamps"], resources["np_array_timestamps"])
+
+        copy_start = time.time()
+        self.shared_resources.read_consistent(snapshot, self.modality_streams(modalities))
+        record_latency(self.shared_resources, "get_states_copy", time.time() - copy_start)
+        timestamps = out["timestamps"]
+        state = {key: value for key, value in out.items() if key != "timestamps"}
         return state, timestamps
 
+    def allocate_state_buffers(self, modalities=None, history=None):
+        """
+		Allocate a dict of output buffers for get_sphero_states(out=...). Reusing one
+		dict across calls keeps polling loops from allocating full-size arrays every call.
+		"""
+        modalities = self.select_modalities(modalities)
+        resources = self.shared_resources.resources
+        sphero_config = self.shared_resources.sphero_config
+        num_frames = len(self.ring_buffer_indices(0, resources["np_array_rgb"].shape[0],
+                                                  sphero_config["CAMERA_OUTPUT_SKIP"]))
+        num_audio_blocks = sphero_config["AUDIO_LENGTH_STATE"]
+        num_sphero_rows = sphero_config["SPHERO_LENGTH_STATE"]
+        if history is not None:
+            num_frames = min(history, num_frames)
+            num_audio_blocks = min(history, num_audio_blocks)
+            num_sphero_rows = min(history, num_sphero_rows)
+
+        out = {"timestamps": np.empty_like(resources["np_array_timestamps"])}
+        if "rgb" in modalities:
+            out["rgb"] = np.empty((num_frames,) + resources["np_array_rgb"].shape[1:],
+                                  dtype=resources["np_array_rgb"].dtype)
+        if "depth" in modalities:
+            out["depth"] = np.empty((num_frames,) + resources["np_array_depth"].shape[1:],
+                                    dtype=resources["np_array_depth"].dtype)
+        if "audio" in modalities:
+            out["audio"] = np.empty((num_audio_blocks * sphero_config["AUDIO_BYTES_PER_SAMPLE"],) +
+                                    resources["np_array_audio"].shape[1:], dtype=resources["np_array_audio"].dtype)
+        if "spheros" in modalities:
+            out["spheros"] = np.empty((sphero_config["SIMULTANEOUS_SPHEROS"], num_sphero_rows) +
+                                      resources["np_array_sphero_states"].shape[2:],
+                                      dtype=resources["np_array_sphero_states"].dtype)
+            out["sphero_timestamps"] = np.empty((sphero_config["SIMULTANEOUS_SPHEROS"], num_sphero_rows),
+                                                dtype=resources["np_array_sphero_row_timestamps"].dtype)
+        return out
+
+    def get_states_between(self, t0, t1, modalities=None, clock=None):
+        """
+		Everything captured between times t0 and t1 (time.time() seconds, inclusive), for
+		lining sensor data up with what the robots were doing. Only covers what is still in
+		the buffers, i.e. the last STATE_LEN_TIME_SECS.
+
+		clock is an optional array of times to resample onto: rgb and depth become the newest
+		frame captured at or before each time (or the oldest in the window), spheros are linearly interpolated to each time,
+		and audio becomes the AUDIO_SECS_PER_SAMPLE block recorded over each time.
+
+		Returns: state dict with fields "rgb", "depth", "audio", "spheros", each oldest first,
+			and "rgb_timestamps", "depth_timestamps", "audio_timestamps" (one per block) and
+			"sphero_timestamps" with the capture times of each entry. Without a clock,
+			"spheros" and "sphero_timestamps" are lists with one array per sphero, since the
+			spheros stream independently.
+		"""
+        self.shared_resources.wait_for_library_state(lambda state: state == RUNNING)
+
+        modalities = self.select_modalities(modalities)
+        resources = self.shared_resources.resources
+        sphero_config = self.shared_resources.sphero_config
+        if clock is not None:
+            clock = np.asarray(clock, dtype=np.float64)
+
+        def select(pointer, ring_timestamps):
+            # Ring indices in the window oldest first, and with a clock the entry at or after each time
+            indices = self.ring_buffer_indices(pointer, len(ring_timestamps), 1)
+            # Slots that were never written have timestamp 0
+            indices = indices[(ring_timestamps[indices] >= t0) & (ring_timestamps[indices] <= t1) &
+                              (ring_timestamps[indices] > 0)]
+            return indices, ring_timestamps[indices]
+
+        def nearest_before(indices, times):
+            return indices[np.clip(np.searchsorted(times, clock, side="right") - 1, 0, len(indices) - 1)]
+
+        def snapshot():
+            state = dict()
+            for modality in ["rgb", "depth"]:
+                if modality in modalities:
+                    indices, times = select(resources[f"{modality}_ring_buffer_pointer"].value,
+                                            resources[f"np_array_{modality}_timestamps"])
+                    if clock is not None and len(indices):
+                        indices = nearest_before(indices, times)
+                    state[modality] = resources[f"np_array_{modality}"][indices]
+                    state[f"{modality}_timestamps"] = resources[f"np_array_{modality}_timestamps"][indices]
+            if "audio" in modalities:
+                indices, times = select(resources["audio_ring_buffer_pointer"].value,
+                                        resources["np_array_audio_timestamps"])
+                if clock is not None and len(indices):
+                    # A block's timestamp is when it finished recording
+                    indices = indices[np.clip(np.searchsorted(times, clock, side="left"), 0, len(indices) - 1)]
+                    state["audio"] = resources["np_array_audio_blocks"][indices]
+                else:
+                    state["audio"] = resources["np_array_audio_blocks"][indices].reshape(
+                        (-1,) + resources["np_array_audio"].shape[1:])
+                state["audio_timestamps"] = resources["np_array_audio_timestamps"][indices]
+            if "spheros" in modalities:
+                state["spheros"], state["sphero_timestamps"] = [], []
+                for sphero_elt, pointer in enumerate(resources["np_array_sphero_ring_pointers"]):
+                    indices, times = select(pointer, resources["np_array_sphero_row_timestamps"][sphero_elt])
+                    rows = resources["np_array_sphero_states"][sphero_elt][indices]
+                    if clock is not None:
+                        rows, times = self.interpolate_rows(rows, times, clock), clock
+                    state["spheros"].append(rows)
+                    state["sphero_timestamps"].append(times)
+                if clock is not None:
+                    state["spheros"] = np.stack(state["spheros"]).reshape(
+                        (sphero_config["SIMULTANEOUS_SPHEROS"], len(clock), -1))
+                    state["sphero_timestamps"] = np.stack(state["sphero_timestamps"])
+            return state
+
+        return self.shared_resources.read_consistent(snapshot, self.modality_streams(modalities))
+
+    def get_state_at(self, t, modalities=None):
+        """
+		The state of every modality at time t: the newest rgb and depth frames captured at or
+		before t, the audio block recorded over t, and sphero rows interpolated to t.
+		Same fields as get_states_between, without the time axis. Camera and audio fields with
+		nothing captured over t are None. Spheros are held at their oldest/newest row outside
+		the rows buffered, and are NaN with none.
+		"""
+        # Resample everything buffered, the rows either side of t are needed to pick the ones over it
+        state = self.get_states_between(0, np.inf, modalities, clock=[t])
+        at_t = {key: value[:, 0] if key in ["spheros", "sphero_timestamps"] else value[0] if len(value) else None
+                for key, value in state.items()}
+        for modality in ["rgb", "depth"]:
+            if at_t.get(f"{modality}_timestamps") is not None and at_t[f"{modality}_timestamps"] > t:
+                at_t[modality] = at_t[f"{modality}_timestamps"] = None
+        # An audio block is stamped when it finished recording
+        audio_end = at_t.get("audio_timestamps")
+        if audio_end is not None and not \
+                audio_end - self.shared_resources.sphero_config["AUDIO_SECS_PER_SAMPLE"] <= t <= audio_end:
+            at_t["audio"] = at_t["audio_timestamps"] = None
+        return at_t
+
+    @staticmethod
+    def interpolate_rows(rows, times, clock):
+        """
+		Linearly interpolate rows (one per time in times, ascending) to every time in clock,
+		all columns at once. Times outside the rows are held at the first/last row.
+		"""
+        if len(rows) < 2:
+            return np.full((len(clock), rows.shape[1]), np.nan if len(rows) == 0 else rows[0], dtype=rows.dtype)
+        upper = np.clip(np.searchsorted(times, clock), 1, len(times) - 1)
+        lower = upper - 1
+        span = times[upper] - times[lower]
+        weight = np.clip(np.divide(clock - times[lower], span, out=np.zeros_like(clock), where=span > 0), 0, 1)
+        return (rows[lower] * (1 - weight[:, None]) + rows[upper] * weight[:, None]).astype(rows.dtype)
+
+    def select_modalities(self, modalities):
+        """
+		Validate a requested subset of MODALITIES, defaulting to everything this arena has.
+		"""
+        available = [modality for modality in MODALITIES if modality != "spheros" or
+                     self.shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"] > 0]
+        if modalities is None:
+            return available
+        for modality in modalities:
+            assert modality in available, f"modality must be one of {available}"
+        return list(modalities)
+
+    def modality_streams(self, modalities):
+        """
+		Indices into np_array_timestamps (and the seqlock counters) backing the given modalities.
+		"""
+        streams = [MODALITIES.index(modality) for modality in modalities if modality != "spheros"]
+        if "spheros" in modalities:
+            streams += [3 + sphero_elt for sphero_elt in range(self.shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"])]
+        return streams
+
+    def wait_for_update(self, modality, since=None, timeout=None, sphero_num=0):
+        """
+		Block until modality (one of MODALITIES, sphero_num picks the sphero) has a sample
+		newer than generation since, without polling. since defaults to the current generation,
+		i.e. wait for the next sample. Generations are np_array_packet_counters, which reset when
+		the library resets.
+
+		Returns the new generation, or None if timeout seconds pass first.
+		"""
+        self.select_modalities([modality])
+        stream = self.modality_streams([modality])[sphero_num if modality == "spheros" else 0]
+        if since is None:
+            since = int(self.shared_resources.resources["np_array_packet_counters"][stream])
+        return self.shared_resources.wait_for_update(stream, since, timeout)
+
+    def iter_updates(self, modality, sphero_num=0, timeout=None, history=1):
+        """
+		Generator yielding (generation, state, timestamps) for each new sample of modality,
+		with state as from get_sphero_states(modalities=[modality], history=history).
+		Samples that arrive while the consumer is busy are coalesced, visible as a jump
+		in generation. state reuses the same buffers on every iteration. Stops if timeout
+		seconds pass without a new sample.
+		"""
+        out = self.allocate_state_buffers([modality], history)
+        generation = None
+        while True:
+            generation = self.wait_for_update(modality, since=generation, timeout=timeout, sphero_num=sphero_num)
+            if generation is None:
+                return
+            state, timestamps = self.get_sphero_states(out=out, modalities=[modality], history=history)
+            yield generation, state, timestamps
+
+    @staticmethod
+    def ring_buffer_indices(pointer, length, skip):
+        """
+        Indices of every skip-th frame of a ring buffer, oldest first and ending on the newest frame.
+        pointer is the next index to be written (the oldest frame).
+        """
+        return (pointer + np.arange(length - 1, -1, -skip)[::-1]) % length
+
     def set_sphero_action(self, spheroNum, spheroHeading, spheroSpeed):
         """
 		If the library is in an up-state, will send an action to a sphero.
 		Action = heading (0-360), speed (0-255).
 
-		Returns True when the message gets through.
+		Returns True when the message gets through, False if the sphero is
+		unavailable (see get_sphero_health) or drops before taking it.
 		"""
         assert self.shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"] > 0, "no spheros in this arena"
         assert type(
@@ -89,20 +346,106 @@ class SpheroLibrary:
             "spheroHeading must be int between 0, 360"
         assert type(isinstance(spheroSpeed, int)) and 0 <= spheroSpeed <= 255, "spheroSpeed must be int between 0, 255"
 
-        while self.shared_resources.resources["library_state"].value != 5:
-            time.sleep(.001)
+        self.shared_resources.wait_for_library_state(lambda state: state == RUNNING)
+        if not self.sphero_available(spheroNum):
+            return False
 
-        while self.shared_resources.resources["np_array_sphero_actions"][spheroNum][2] != 0:
-            time.sleep(.001)
+        self.shared_resources.wait_for_action_taken(spheroNum)
+        if not self.sphero_available(spheroNum):
+            return False
         self.shared_resources.resources["np_array_sphero_actions"][spheroNum][0] = spheroHeading
         self.shared_resources.resources["np_array_sphero_actions"][spheroNum][1] = spheroSpeed
+        action_start = time.time()
         self.shared_resources.resources["np_array_sphero_actions"][spheroNum][2] = 1
 
         # Wait until message is taken before returning
-        while self.shared_resources.resources["np_array_sphero_actions"][spheroNum][2] != 0:
-            time.sleep(.001)
+        self.shared_resources.wait_for_action_taken(spheroNum)
+        if not self.sphero_available(spheroNum):
+            return False
+        record_latency(self.shared_resources, f"sphero{spheroNum}_action_round_trip", time.time() - action_start)
         return True
 
+    def get_stream_rates(self):
+        """
+		Measured rate of every stream, as moving averages kept by the stream producers.
+
+		Returns: dict of stream name ("rgb", "depth", "audio", "sphero<n>") to dict with "rate"
+			and "expected_rate" (hz), "jitter" (seconds), and "degraded", True while the sensor
+			monitor finds the stream running slower than STREAM_DEGRADED_RATIO allows.
+		"""
+        resources = self.shared_resources.resources
+        sphero_config = self.shared_resources.sphero_config
+        rates = resources["np_array_stream_rates"].copy()
+        return {name: {"rate": float(1 / period) if period else None, "expected_rate": float(1 / expected),
+                       "jitter": float(jitter), "degraded": bool(degraded)}
+                for name, (_, period, jitter), expected, degraded in zip(
+                    stream_names(sphero_config), rates, expected_stream_periods(sphero_config),
+                    resources["np_array_stream_degraded"])}
+
+    def get_sphero_health(self):
+        """
+		Health of every sphero, in state_machine's SPHERO_WARMING_UP, SPHERO_READY, SPHERO_LOST.
+		A lost sphero's rows in get_sphero_states are stale, the rest of the library keeps running.
+		"""
+        return self.shared_resources.resources["np_array_sphero_health"].copy()
+
+    def sphero_available(self, sphero_num):
+        return self.shared_resources.resources["np_array_sphero_health"][sphero_num] == SPHERO_READY
+
+    def get_metrics(self):
+        """
+		Latency histograms recorded by the library processes: sensor arrival to shared memory
+		per stream, action round trip, action to ack, BLE write acks, command queue waits and time from
+		dropping a connection to running again per sphero, get_sphero_states copies and
+		state machine events from posting to handling. Also each sphero's command queue counters.
+
+		Returns: dict of metric name to dict with "count", "mean", "max", "p50", "p90", "p99"
+			(seconds, percentiles to histogram bin resolution), "histogram" and "bin_edges".
+			"sphero<n>_command_queue" entries are instead dicts of "depth", "max_depth",
+			"sent" and "coalesced".
+		"""
+        resources = self.shared_resources.resources
+        metrics = summarize_latencies(resources["np_array_latency_histograms"].copy(),
+                                      resources["np_array_latency_stats"].copy(),
+                                      get_metric_names(self.shared_resources.sphero_config))
+        for sphero_elt in range(self.shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"]):
+            metrics[f"sphero{sphero_elt}_command_queue"] = dict(zip(
+                COMMAND_QUEUE_STATS, resources["np_array_sphero_command_queue_stats"][sphero_elt].tolist()))
+        return metrics
+
+    def get_state_trace(self):
+        """
+		Latest library state transitions recorded by the state machine, oldest first, up to
+		STATE_TRACE_LENGTH of them.
+
+		Returns: list of dicts with "time", "event" (the event that triggered it), "event_time"
+			(when that event was posted), "old_state" and "new_state" (STATE_NAMES names).
+		"""
+        resources = self.shared_resources.resources
+
+        # Transitions are rare, so just copy again if one lands mid-copy
+        while True:
+            pointer = int(resources["np_array_state_trace_pointer"][0])
+            trace = resources["np_array_state_trace"].copy()
+            if resources["np_array_state_trace_pointer"][0] == pointer:
+                break
+        indices = np.arange(pointer - min(pointer, len(trace)), pointer) % len(trace)
+        return [{"time": float(trace[index, 0]), "event_time": float(trace[index, 1]),
+                 "event": EVENTS[int(trace[index, 2])], "old_state": STATE_NAMES[int(trace[index, 3])],
+                 "new_state": STATE_NAMES[int(trace[index, 4])]} for index in indices]
+
+    def get_state_durations(self):
+        """
+		Seconds the library has spent in each state since it started, e.g. warm up
+		("waiting_for_sensors") vs "running". Includes the time so far in the current state.
+		"""
+        resources = self.shared_resources.resources
+        durations = dict(zip([STATE_NAMES[state] for state in STATES], resources["np_array_state_durations"].tolist()))
+        if resources["np_array_state_entered"][0]:
+            durations[STATE_NAMES[resources["library_state"].value]] += float(
+                time.time() - resources["np_array_state_entered"][0])
+        return durations
+
     def eliminate_old_pids(self):
         """
 		Sometimes older versions of ourselves fail to kill the 
@@ -120,7 +463,7 @@ class SpheroLibrary:
                     if "sphero" in splitted[0] or "sphero" in splitted[1]:
                         if int(pid) != our_pid and "collector_manager" not in splitted[1]:
                             print(splitted)
-                            self.shared_resources.resources["logging_queue"].put("Killing old pids: {}".format(pid))
+                            log_message(self.shared_resources, "library", "Killing old pids: {}".format(pid))
                             subprocess.call(["kill", pid])
             except IOError:  # proc has already terminated
                 continue
@@ -1,5 +1,8 @@
-from SpheroLib.sphero_bluetooth import run_sphero
+from SpheroLib.sphero_bluetooth import run_sphero_worker
+from SpheroLib.log_ring import log_message
 import multiprocessing as mp
+from multiprocessing import connection
+import numpy as np
 import time
 # from slackclient import SlackClient
 import subprocess
@@ -8,61 +11,106 @@ import subprocess
 class SpheroManager:
     def __init__(self, shared_resources):
         """
-        Spin up the sphero processes. Monitor them for good health. If they die, restart them. TODO: Alert State Machine
+        Spin up the sphero worker processes, sharding the spheros across SPHERO_PROCESSES of them. Workers
+        restart their own spheros when connections drop. Monitor the workers for good health. If they die,
+        restart them, backing off exponentially if they keep dying. TODO: Alert State Machine
         """
         shared_resources.get_numpy_resources()
         self.shared_resources = shared_resources
-        self.process_data = {sphero_num: {"pid": None, "proc": None, "kill_switch": None, "reboot_status": None} for \
-                             sphero_num in range(shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"])}
-        [self.start_sphero_process(sphero_num) for sphero_num in
-         range(shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"])]
+        num_spheros = shared_resources.sphero_config["SIMULTANEOUS_SPHEROS"]
+        num_workers = min(shared_resources.sphero_config["SPHERO_PROCESSES"] or num_spheros, num_spheros)
+        self.process_data = {sphero_num: {"kill_switch": mp.Value('i'), "reboot_status": None} for \
+                             sphero_num in range(num_spheros)}
+        # With no spheros there are no workers, and we just idle in the monitor loop
+        shards = np.array_split(np.arange(num_spheros), num_workers) if num_workers else []
+        self.worker_data = {worker: {"pid": None, "proc": None, "sphero_nums": shard.tolist(),
+                                     "start_time": None, "restart_time": None, "failures": 0} for worker, shard in
+                            enumerate(shards)}
+        [self.start_worker_process(worker) for worker in self.worker_data]
         self.monitor_sphero_processes()
 
-    def start_sphero_process(self, sphero_num):
-        self.shared_resources.resources["logging_queue"].put_nowait(
-            f"[Sphero Manager] Starting sphero {sphero_num} process.")
-        kill_switch = mp.Value('i')
-        kill_switch.value = 0
-        sphero_proc = mp.Process(target=run_sphero, args=(self.shared_resources, sphero_num, kill_switch))
-        # print (sphero_proc.daemon)
-        sphero_proc.daemon = True
-        sphero_proc.start()
-        self.process_data[sphero_num]["pid"] = sphero_proc.pid
-        self.process_data[sphero_num]["proc"] = sphero_proc
-        self.process_data[sphero_num]["kill_switch"] = kill_switch
-        self.process_data[sphero_num]["reboot_status"] = "ongoing"
+    def start_worker_process(self, worker):
+        sphero_nums = [sphero_num for sphero_num in self.worker_data[worker]["sphero_nums"]
+                       if self.process_data[sphero_num]["reboot_status"] != "stopped"]
+        if not sphero_nums:
+            log_message(self.shared_resources, "sphero_manager",
+                        f"[Sphero Manager] Not restarting worker {worker}, all its spheros are stopped.")
+            self.worker_data[worker]["proc"] = None
+            self.worker_data[worker]["restart_time"] = None
+            return
+        log_message(self.shared_resources, "sphero_manager",
+                    f"[Sphero Manager] Starting worker {worker} process for spheros {sphero_nums}.")
+        for sphero_num in sphero_nums:
+            self.process_data[sphero_num]["kill_switch"].value = 0
+            self.process_data[sphero_num]["reboot_status"] = "ongoing"
+        worker_proc = mp.Process(target=run_sphero_worker, args=(
+            self.shared_resources, sphero_nums, [self.process_data[sphero_num]["kill_switch"] for sphero_num in sphero_nums]))
+        worker_proc.daemon = True
+        worker_proc.start()
+        self.worker_data[worker]["pid"] = worker_proc.pid
+        self.worker_data[worker]["proc"] = worker_proc
+        self.worker_data[worker]["start_time"] = time.time()
+        self.worker_data[worker]["restart_time"] = None
+
+    def schedule_worker_restart(self, worker):
+        """
+        Respawn a dead worker after SPHERO_RESTART_MIN_SECS, doubling the wait each time it dies again soon
+        after starting, up to SPHERO_RESTART_MAX_SECS. Its spheros count as down from now.
+        """
+        data = self.worker_data[worker]
+        min_secs = self.shared_resources.sphero_config["SPHERO_RESTART_MIN_SECS"]
+        max_secs = self.shared_resources.sphero_config["SPHERO_RESTART_MAX_SECS"]
+        # A worker that stayed up longer than the longest wait was healthy, so start the backoff over
+        if time.time() - data["start_time"] > max_secs:
+            data["failures"] = 0
+        delay = min(min_secs * 2 ** data["failures"], max_secs)
+        data["failures"] += 1
+        data["proc"] = None
+        data["restart_time"] = time.time() + delay
+        down_since = self.shared_resources.resources["np_array_sphero_down_since"]
+        for sphero_num in data["sphero_nums"]:
+            if down_since[sphero_num] == 0:
+                down_since[sphero_num] = time.time()
+        log_message(self.shared_resources, "sphero_manager",
+                    f"[Sphero Manager] Restarting worker {worker} in {delay:.2f}s")
 
     def monitor_sphero_processes(self):
         """
-        If a sphero process goes down, restart it.
+        If a worker process goes down, restart it. Log spheros restarting inside their worker, and ones
+        that have stopped on low battery.
         """
         while True:
-            time.sleep(.001)
+            # Sleep until a worker exits. Kill switches are shared values, so look at them on a timeout too.
+            connection.wait([data["proc"].sentinel for data in self.worker_data.values() if data["proc"] is not None],
+                            timeout=.1)
             for sphero_num in self.process_data.keys():
                 if self.process_data[sphero_num]["kill_switch"].value == 2:  # Low Battery
                     if self.process_data[sphero_num]["reboot_status"] == "stopped":
                         continue
-                    self.shared_resources.resources["logging_queue"].put_nowait(
-                        f"[Sphero Manager] sphero{sphero_num} is low on charge. Alerting slack.")
-                    self.process_data[sphero_num]["proc"].terminate()
+                    log_message(self.shared_resources, "sphero_manager",
+                                f"[Sphero Manager] sphero{sphero_num} is low on charge. Alerting slack.")
                     # slackclient = SlackClient(self.shared_resources.sphero_config["SLACKTOKEN"])
                     # slackclient.api_call("chat.postMessage", channel="sphero_slack",
                     #                      text=f"Sphero {sphero_num} low battery. "
                     #                           f"Volts= {self.shared_resources.resources['np_array_sphero_battery']}")
                     self.process_data[sphero_num]["reboot_status"] = "stopped"
                 elif self.process_data[sphero_num]["kill_switch"].value == 1:  # Kill Switch
-                    self.shared_resources.resources["logging_queue"].put_nowait(
-                        f"[Sphero Manager] sphero{sphero_num} process has pulled kill switch")
-                    self.process_data[sphero_num]["proc"].terminate()
-                    while self.process_data[sphero_num]["proc"].exitcode is None:
-                        time.sleep(.01)
-                    self.process_data[sphero_num]["proc"].join()
-                    self.start_sphero_process(sphero_num)
+                    if self.process_data[sphero_num]["reboot_status"] == "restarting":
+                        continue
+                    log_message(self.shared_resources, "sphero_manager",
+                                f"[Sphero Manager] sphero{sphero_num} has pulled kill switch, "
+                                f"its worker is restarting it")
+                    self.process_data[sphero_num]["reboot_status"] = "restarting"
+                elif self.process_data[sphero_num]["reboot_status"] == "restarting":
+                    self.process_data[sphero_num]["reboot_status"] = "ongoing"
 
-                elif not self.process_data[sphero_num]["proc"].is_alive():
-                    self.shared_resources.resources["logging_queue"].put_nowait(
-                        f"[Sphero Manager] sphero{sphero_num} process has died")
-                    self.process_data[sphero_num]["proc"].join()
-                    print(self.process_data[sphero_num])
-                    time.sleep(30)
-                    self.start_sphero_process(sphero_num)
+            for worker in self.worker_data.keys():
+                if self.worker_data[worker]["proc"] is not None and not self.worker_data[worker]["proc"].is_alive():
+                    log_message(self.shared_resources, "sphero_manager",
+                                f"[Sphero Manager] worker {worker} process has died")
+                    self.worker_data[worker]["proc"].join()
+                    print(self.worker_data[worker])
+                    self.schedule_worker_restart(worker)
+                elif self.worker_data[worker]["restart_time"] is not None and \
+                        time.time() >= self.worker_data[worker]["restart_time"]:
+                    self.start_worker_process(worker)
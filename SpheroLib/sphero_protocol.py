@@ -0,0 +1,260 @@
+"""
+Sphero API v2 framing, independent of the bluetooth library.
+
+Packets are [start flags (targetID) (sourceID) deviceID commandID seqNum data checksum end]
+with checksum = ~sum(flags ... data) & 0xff. Start, end and escape bytes inside a packet are
+sent as the escape byte followed by the byte with escapeMask cleared, e.g. 171 -> (171, 35).
+"""
+
+import math
+import struct
+from SpheroLib.bluetooth_constants import APIConstants, Flags, DeviceId, PowerCommandIds, DrivingCommandIds, \
+    SensorCommandIds, UserIOCommandIds, SensorMask
+
+START_OF_PACKET = bytes([APIConstants["startOfPacket"]])
+END_OF_PACKET = bytes([APIConstants["endOfPacket"]])
+ESCAPE = bytes([APIConstants["escape"]])
+RESERVED_BYTES = frozenset([APIConstants["startOfPacket"], APIConstants["endOfPacket"], APIConstants["escape"]])
+# (raw byte, escaped pair). Unescaping must do the escape byte itself last, so that an
+# unescaped 171 can't pair up with the byte after it.
+ESCAPE_SEQUENCES = [(bytes([raw]), ESCAPE + bytes([raw & ~APIConstants["escapeMask"]]))
+                    for raw in [APIConstants["startOfPacket"], APIConstants["endOfPacket"], APIConstants["escape"]]]
+# Shortest packet body worth decoding: flags deviceID commandID seqNum checksum
+MIN_BODY_LENGTH = 5
+
+# Readable name of every (deviceId, commandId) in bluetooth_constants, e.g. "sensor.sensorResponse"
+COMMAND_NAMES = {(DeviceId[device], command_id): f"{device}.{command}"
+                 for device, command_ids in [("powerInfo", PowerCommandIds), ("driving", DrivingCommandIds),
+                                             ("sensor", SensorCommandIds), ("userIO", UserIOCommandIds)]
+                 for command, command_id in command_ids.items()}
+
+# Sensor mask bit streaming each output variable. Gyro bits belong to the extended sensor mask.
+SENSOR_MASK_BITS = {'pitch': 'imuPitchAngleFiltered', 'roll': 'imuRollAngleFiltered', 'yaw': 'imuYawAngleFiltered',
+                    'ax': 'accelerometerXFiltered', 'ay': 'accelerometerYFiltered', 'az': 'accelerometerZFiltered',
+                    'positionX': 'locatorX', 'positionY': 'locatorY',
+                    'velocityX': 'velocityX', 'velocityY': 'velocityY'}
+EXTENDED_SENSOR_MASK_BITS = {'wx': 'gyroXFiltered', 'wy': 'gyroYFiltered', 'wz': 'gyroZFiltered'}
+
+
+def sensor_stream_layout(variables):
+    """
+    Sensor mask, extended sensor mask and the order of the big endian floats in each sensor response,
+    for a stream of exactly the given variables. The sphero sends the mask's values from its highest bit
+    down, then the extended mask's.
+    """
+    mask = sum(SensorMask[SENSOR_MASK_BITS[variable]] for variable in set(variables) if variable in SENSOR_MASK_BITS)
+    extended_mask = sum(SensorMask[EXTENDED_SENSOR_MASK_BITS[variable]] for variable in set(variables)
+                        if variable in EXTENDED_SENSOR_MASK_BITS)
+    unknown = set(variables) - set(SENSOR_MASK_BITS) - set(EXTENDED_SENSOR_MASK_BITS)
+    assert not unknown, f"No sensor streams {unknown}"
+    response_variables = sorted(set(variables) & set(SENSOR_MASK_BITS),
+                                key=lambda variable: -SensorMask[SENSOR_MASK_BITS[variable]])
+    response_variables += sorted(set(variables) & set(EXTENDED_SENSOR_MASK_BITS),
+                                 key=lambda variable: -SensorMask[EXTENDED_SENSOR_MASK_BITS[variable]])
+    return mask, extended_mask, response_variables
+
+
+# Every sensor, as streamed before the mask was derived from SPHERO_OUTPUT_VARIABLES
+SENSOR_RESPONSE_VARIABLES = sensor_stream_layout(list(SENSOR_MASK_BITS) + list(EXTENDED_SENSOR_MASK_BITS))[2]
+# Locator values come in meters, the library reports centimeters
+SENSOR_RESPONSE_SCALES = {'positionX': 100., 'positionY': 100., 'velocityX': 100., 'velocityY': 100.}
+
+
+def escape(body):
+    """
+    Byte-stuff a packet body (everything between start and end).
+    """
+    body = bytes(body)
+    # The escape byte goes first, or it would re-escape the pairs made for the others
+    for raw, escaped in ESCAPE_SEQUENCES[::-1]:
+        body = body.replace(raw, escaped)
+    return body
+
+
+def unescape(body):
+    """
+    Undo escape(). Escaped bytes are rare, so skip the work when there are none.
+    """
+    if ESCAPE not in body:
+        return bytes(body)
+    body = bytes(body)
+    for raw, escaped in ESCAPE_SEQUENCES:
+        body = body.replace(escaped, raw)
+    return body
+
+
+def checksum(body):
+    return ~sum(body) & 0xff
+
+
+def command_name(device_id, command_id):
+    return COMMAND_NAMES.get((device_id, command_id), f"{device_id}.{command_id}")
+
+
+class PacketDecoder:
+    """
+    Streaming decoder for notification fragments. Works on whole notifications at once: bytes.find
+    locates start/end markers, unescape() runs a handful of bulk replaces, and the checksum is one
+    sum() over the body, so no per-byte Python runs on the GATT callback.
+
+    A start byte always begins a new packet, dropping any unfinished one. Packets that are too
+    short or fail their checksum are dropped and counted in stats.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.stats = {"packets": 0, "bad_checksum": 0, "too_small": 0}
+
+    def reset(self):
+        """
+        Drop any partially received packet.
+        """
+        self.buffer.clear()
+
+    def feed(self, value):
+        """
+        Add a notification's bytes. Returns the unescaped packets it completed, each as bytes
+        including start, checksum and end.
+        """
+        buffer = self.buffer
+        buffer += value
+        packets = []
+        position = 0
+        while True:
+            start = buffer.find(START_OF_PACKET, position)
+            if start < 0:
+                # Nothing here can become a packet
+                buffer.clear()
+                return packets
+            end = buffer.find(END_OF_PACKET, start)
+            if end < 0:
+                del buffer[:start]
+                return packets
+            start = buffer.rfind(START_OF_PACKET, start, end)
+            position = end + 1
+
+            body = unescape(buffer[start + 1:end])
+            if len(body) < MIN_BODY_LENGTH:
+                self.stats["too_small"] += 1
+            elif checksum(body[:-1]) != body[-1]:
+                self.stats["bad_checksum"] += 1
+            else:
+                self.stats["packets"] += 1
+                packets.append(START_OF_PACKET + body + END_OF_PACKET)
+
+
+class CommandEncoder:
+    """
+    Builds byte-stuffed command packets. The escaped header and checksum contribution of each
+    (deviceId, commandId, targetId) are worked out the first time it is sent, so a frequent command
+    like driveWithHeading costs one sum over seqNum and data, and escaping only when it holds a
+    reserved byte.
+    """
+
+    def __init__(self):
+        self.seq_number = 0
+        self.headers = dict()
+
+    def header(self, device_id, command_id, target_id):
+        """
+        Start byte plus escaped [flags (targetID) deviceID commandID], and the sum of those bytes.
+        """
+        # As in the JS library, the target id is or-ed into the flags too
+        flags = Flags["requestsResponse"] | Flags["resetsInactivityTimeout"] | (target_id or 0)
+        header = bytes([flags] + ([] if target_id is None else [target_id]) + [device_id, command_id])
+        self.headers[(device_id, command_id, target_id)] = (START_OF_PACKET + escape(header), sum(header))
+        return self.headers[(device_id, command_id, target_id)]
+
+    def encode(self, device_id, command_id, target_id=None, data=b""):
+        """
+        Packet bytes for a command with the next sequence number. data is any iterable of byte values.
+        """
+        seq_number = self.seq_number = (self.seq_number + 1) % 255
+        header = self.headers.get((device_id, command_id, target_id))
+        prefix, header_sum = header if header is not None else self.header(device_id, command_id, target_id)
+        body = (seq_number, *data)
+        body = bytes((*body, ~(header_sum + sum(body)) & 0xff))
+        if not RESERVED_BYTES.isdisjoint(body):
+            body = escape(body)
+        return prefix + body + END_OF_PACKET
+
+
+class Frame:
+    """
+    One unescaped packet from PacketDecoder. Header fields are indexed straight out of the packet and
+    data is a memoryview slice of it, so reading a message copies nothing.
+    """
+    __slots__ = ["packet", "flags", "deviceId", "commandId", "seqNumber", "data"]
+
+    def __init__(self, packet):
+        self.packet = packet
+        self.flags = packet[1]
+        # Optional target and source ids sit between flags and deviceId
+        header = 2 + (self.flags & Flags["commandHasTargetId"] > 0) + (self.flags & Flags["commandHasSourceId"] > 0)
+        self.deviceId = packet[header]
+        self.commandId = packet[header + 1]
+        self.seqNumber = packet[header + 2]
+        self.data = memoryview(packet)[header + 3:-2]
+
+    @property
+    def isResponse(self):
+        return bool(self.flags & Flags["isResponse"])
+
+    @property
+    def requestsResponse(self):
+        return bool(self.flags & Flags["requestsResponse"])
+
+    @property
+    def requestsOnlyErrorResponse(self):
+        return bool(self.flags & Flags["requestsOnlyErrorResponse"])
+
+    @property
+    def resetsInactivityTimeout(self):
+        return bool(self.flags & Flags["resetsInactivityTimeout"])
+
+    @property
+    def hasTargetId(self):
+        return bool(self.flags & Flags["commandHasTargetId"])
+
+    @property
+    def hasSourceId(self):
+        return bool(self.flags & Flags["commandHasSourceId"])
+
+    @property
+    def targetId(self):
+        return self.packet[2] if self.hasTargetId else None
+
+    @property
+    def sourceId(self):
+        return self.packet[2 + self.hasTargetId] if self.hasSourceId else None
+
+    @property
+    def checksum(self):
+        return self.packet[-2]
+
+    def __repr__(self):
+        return f"Frame(deviceId={self.deviceId}, commandId={self.commandId}, seqNumber={self.seqNumber}, " \
+               f"flags={self.flags}, data={bytes(self.data).hex()})"
+
+
+class SensorResponseDecoder:
+    """
+    Turns sensor response data into a state row ordered like SPHERO_OUTPUT_VARIABLES. Everything
+    but one precompiled struct unpack and the reorder/scale is worked out once, up front.
+    """
+
+    def __init__(self, output_variables, response_variables=SENSOR_RESPONSE_VARIABLES):
+        self.struct = struct.Struct(f">{len(response_variables)}f")
+        self.size = self.struct.size
+        self.layout = [(response_variables.index(variable), SENSOR_RESPONSE_SCALES.get(variable, 1.))
+                       for variable in output_variables]
+
+    def decode(self, data):
+        """
+        Row of output variables as a list, or None if the packet holds nans.
+        """
+        values = self.struct.unpack(data)
+        # Any nan makes the sum nan, which is cheaper than testing each value
+        if math.isnan(sum(values)):
+            return None
+        return [values[index] * scale for index, scale in self.layout]
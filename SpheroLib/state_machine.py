@@ -1,5 +1,77 @@
+from SpheroLib.metrics import record_latency
+from SpheroLib.log_ring import log_message
 import time
 
+# Library states. The values are what library_state has always held.
+DISCONNECTED = 0
+WAITING_FOR_SENSORS = 1
+BATTERIES_LOW = 2
+RUNNING = 5
+FAILED = -1
+STATE_NAMES = {DISCONNECTED: "disconnected", WAITING_FOR_SENSORS: "waiting_for_sensors",
+               BATTERIES_LOW: "batteries_low", RUNNING: "running", FAILED: "failed"}
+# Row of each state in np_array_state_durations
+STATES = list(STATE_NAMES)
+
+# Events other processes post with post_event(). Their index here is what the state trace records.
+EVENTS = ["RESETSTATEVARS", "ALLSENSORSGO", "SPHEROLOST", "BATTERIESLOW", "RGBLOST", "DEPTHLOST", "AUDIOLOST"]
+
+# (state, event): new state. A None state matches every state, and is checked after the exact match.
+# Events with no entry for the current state are ignored.
+TRANSITIONS = {
+    # Failures no matter what state we are in
+    (None, "RGBLOST"): FAILED,
+    (None, "DEPTHLOST"): FAILED,
+    (None, "AUDIOLOST"): FAILED,
+    (DISCONNECTED, "RESETSTATEVARS"): WAITING_FOR_SENSORS,
+    (WAITING_FOR_SENSORS, "ALLSENSORSGO"): RUNNING,
+    (WAITING_FOR_SENSORS, "SPHEROLOST"): DISCONNECTED,
+    # A lost sphero only takes itself out while running (see SPHERO_LOST)
+    (RUNNING, "BATTERIESLOW"): BATTERIES_LOW,
+    # Nothing leaves FAILED, it is unrecoverable
+}
+
+# Columns of np_array_state_trace, one row per transition
+STATE_TRACE = ["time", "event_time", "event", "old_state", "new_state"]
+
+# Per sphero health in np_array_sphero_health. The sensor monitor is its only writer. A lost sphero
+# is left out while the rest of the library keeps running, and is ready again once it has re-warmed.
+SPHERO_WARMING_UP = 0
+SPHERO_READY = 1
+SPHERO_LOST = 2
+
+
+def post_event(shared_resources, event):
+    """
+    Tell the state machine something happened. The event carries the time it was posted, so
+    the state machine can measure how long events take to reach it.
+    """
+    shared_resources.resources["state_machine_queue"].put((event, time.time()))
+
+
+def next_state(state, event):
+    """
+    State the library moves to from state on event, per TRANSITIONS.
+    """
+    if (state, event) in TRANSITIONS:
+        return TRANSITIONS[(state, event)]
+    return TRANSITIONS.get((None, event), state)
+
+
+def record_transition(shared_resources, event, event_time, old_state, new_state):
+    """
+    Add a transition to the shared trace ring, and the time spent in old_state to its total.
+    """
+    resources = shared_resources.resources
+    now = time.time()
+    resources["np_array_state_durations"][STATES.index(old_state)] += now - resources["np_array_state_entered"][0]
+    resources["np_array_state_entered"][0] = now
+    pointer = resources["np_array_state_trace_pointer"][0]
+    resources["np_array_state_trace"][pointer % len(resources["np_array_state_trace"])] = \
+        [now, event_time, EVENTS.index(event), old_state, new_state]
+    # Bump the pointer last, so readers never see a half written row as the newest
+    resources["np_array_state_trace_pointer"][0] = pointer + 1
+
 
 def run_state_machine(shared_resources):
     """
@@ -10,43 +82,19 @@ def run_state_machine(shared_resources):
     conduct business. They should never change it.
     """
     shared_resources.get_numpy_resources()
+    shared_resources.resources["np_array_state_entered"][0] = time.time()
     while True:
-        time.sleep(.001)
-        if not shared_resources.resources["state_machine_queue"].empty():
-            data = shared_resources.resources["state_machine_queue"].get()
-            old_state = shared_resources.resources["library_state"].value
-
-            # Failures no matter what state we are in
-            if data in ["AUDIOLOST", "RGBLOST", "DEPTHLOST"]:
-                shared_resources.resources["library_state"].value = -1
-
-            # Disconnected
-            if shared_resources.resources["library_state"].value == 0:
-                if data == "RESETSTATEVARS":
-                    shared_resources.resources["library_state"].value = 1
-
-            # Waiting for spheros (all sensors)
-            elif shared_resources.resources["library_state"].value == 1:
-                if data == "ALLSENSORSGO":
-                    shared_resources.resources["library_state"].value = 5
-
-                elif data == "SPHEROLOST":
-                    shared_resources.resources["library_state"].value = 0
-
-            # Running action on sphero
-            elif shared_resources.resources["library_state"].value == 5:
-                if data == "SPHEROLOST":
-                    shared_resources.resources["library_state"].value = 0
-                elif data == "BATTERIESLOW":
-                    shared_resources.resources["library_state"].value = 2
-
-            # Unrecoverable failure state
-            elif shared_resources.resources["library_state"].value == -1:
-                pass
-
-            # Log State Changes
-            if old_state != shared_resources.resources["library_state"].value:
-                shared_resources.resources["logging_queue"].put(
-                    f"State Machine: Old State={old_state}, "
-                    f"New State={shared_resources.resources['library_state'].value}, "
-                    f"msg={data}")
+        # Sleep until someone has something to tell us
+        event, event_time = shared_resources.resources["state_machine_queue"].get()
+        record_latency(shared_resources, "state_machine_event", time.time() - event_time)
+        old_state = shared_resources.resources["library_state"].value
+        new_state = next_state(old_state, event)
+
+        # Log State Changes
+        if old_state != new_state:
+            record_transition(shared_resources, event, event_time, old_state, new_state)
+            shared_resources.set_library_state(new_state)
+            log_message(shared_resources, "state_machine",
+                        f"State Machine: Old State={STATE_NAMES[old_state]}, "
+                        f"New State={STATE_NAMES[new_state]}, "
+                        f"msg={event}")
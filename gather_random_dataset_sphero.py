@@ -25,6 +25,7 @@ if __name__ == "__main__":
         os.mkdir(dataset_name)
     sphero_lib = SpheroLibrary(sphero_config)
     output = sphero_lib.get_sphero_states()
+    calm_buffers = sphero_lib.allocate_state_buffers(modalities=["spheros"], history=1)
 
     # angles = [60, 0, 300]
     # speeds = [0, 100]
@@ -69,7 +70,8 @@ if __name__ == "__main__":
         calm = False
         calm_start = time.time()
         while not calm:
-            [state, timestamps] = sphero_lib.get_sphero_states()
+            # Only the newest sphero rows, so the settle loop stays cheap
+            [state, timestamps] = sphero_lib.get_sphero_states(out=calm_buffers, modalities=["spheros"], history=1)
             current_state = state["spheros"][0][0]
             speed = (current_state[3] ** 2 + current_state[4] ** 2) ** .5
             rotation = (current_state[5] ** 2 + current_state[6] ** 2 + current_state[7] ** 2) ** .5
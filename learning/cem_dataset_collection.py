@@ -92,6 +92,7 @@ def run_cem_data_collection(config, save_model_path):
     """
     sphero_lib = SpheroLibrary(sphero_config)
     output = sphero_lib.get_sphero_states()
+    calm_buffers = sphero_lib.allocate_state_buffers(modalities=["spheros"], history=1)
     for sample in range(start_num, start_num + num_samples):
         print(f"\rGathering Sample {sample}/{num_samples}", end=' ')
         sample_path = f"{cem_dataset}/{sample}"
@@ -143,7 +144,8 @@ def run_cem_data_collection(config, save_model_path):
         calm = False
         calm_start = time.time()
         while not calm:
-            [state, timestamps] = sphero_lib.get_sphero_states()
+            # Only the newest sphero rows, so the settle loop stays cheap
+            [state, timestamps] = sphero_lib.get_sphero_states(out=calm_buffers, modalities=["spheros"], history=1)
             current_state = state["spheros"][0][0]
             speed = (current_state[3] ** 2 + current_state[4] ** 2) ** .5
             rotation = (current_state[5] ** 2 + current_state[6] ** 2 + current_state[7] ** 2) ** .5